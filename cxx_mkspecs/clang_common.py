@@ -18,7 +18,7 @@ def mkspec_check_clang_version(conf, compiler, major, minor, minimum=False):
     :param minor: The minor version number, e.g. 5
     :param minimum: Only check for a minimum compiler version, if true
     """
-    conf.get_cc_version(cc=compiler, clang=True)
+    conf.mkspec_get_cc_version(compiler, clang=True)
     conf.mkspec_validate_cc_version(major, minor, minimum)
 
 
@@ -47,7 +47,7 @@ def mkspec_clang_configure(
         )
         if minimum:
             clangxx_names = "clang++"
-        cxx = conf.find_program(clangxx_names, path_list=paths)
+        cxx = conf.mkspec_find_program(clangxx_names, path_list=paths)
         cxx = conf.cmd_to_list(cxx)
 
     conf.env["CXX"] = cxx
@@ -66,7 +66,7 @@ def mkspec_clang_configure(
         )
         if minimum:
             clang_names = "clang"
-        cc = conf.find_program(clang_names, path_list=paths)
+        cc = conf.mkspec_find_program(clang_names, path_list=paths)
         cc = conf.cmd_to_list(cc)
 
     conf.env["CC"] = cc
@@ -76,7 +76,7 @@ def mkspec_clang_configure(
 
     # Find the archiver
     ar = conf.mkspec_get_ar_binary_name(prefix)
-    conf.find_program(ar, path_list=paths, var="AR")
+    conf.mkspec_find_program(ar, path_list=paths, var="AR")
     conf.env.ARFLAGS = "rcs"
 
     # Set up C++ tools and flags
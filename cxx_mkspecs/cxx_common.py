@@ -2,9 +2,14 @@
 # encoding: utf-8
 
 import os
+import re
 
+from waflib import ConfigSet
+from waflib import Utils
 from waflib.Configure import conf
 
+import wurf_user_cache
+
 
 @conf
 def mkspec_add_common_flag(conf, flag):
@@ -18,11 +23,54 @@ def mkspec_add_common_flag(conf, flag):
     conf.env["LINKFLAGS"] += [flag]
 
 
+@conf
+def mkspec_check_parallel(conf, compiler, checks):
+    """
+    Run configuration checks in parallel with conf.multicheck.
+
+    The messages of the checks are not printed, since the checks finish in
+    a random order. The caller should print the results in the original
+    order.
+
+    :param compiler: The compiler of the checks, c or cxx
+    :param checks: A list of keyword arguments for each check,
+                   e.g. [{"cxxflags": "-O2"}, {"cxxflags": "-O3"}]
+
+    :return: The list of the results in the order of the checks, a result
+             is True if the check passed
+    """
+    if not checks:
+        return []
+
+    passed = set()
+
+    def passed_msg(index):
+        # The okmsg function of a check is only called if the check passed
+        def okmsg(kw):
+            passed.add(index)
+            return "yes"
+
+        return okmsg
+
+    tests = [
+        dict(kw, compiler=compiler, mandatory=False, okmsg=passed_msg(index))
+        for index, kw in enumerate(checks)
+    ]
+
+    conf.multicheck(
+        *tests, msg="Executing %d configuration checks" % len(tests), errmsg="done"
+    )
+
+    return [index in passed for index in range(len(checks))]
+
+
 @conf
 def mkspec_try_flags(conf, flagtype, flaglist):
     """
     Check support of the given list of compiler/linker flags.
 
+    The flags are checked in parallel (see mkspec_check_parallel).
+
     :param flagtype: The flag type, cflags, cxxflags or linkflags
     :param flaglist: The list of flags to be checked
 
@@ -30,24 +78,142 @@ def mkspec_try_flags(conf, flagtype, flaglist):
     """
     ret = []
 
-    for flag in flaglist:
+    if flagtype == "cflags":
+        compiler = "c"
+    else:
+        compiler = "cxx"
+
+    results = conf.mkspec_check_parallel(compiler, [{flagtype: f} for f in flaglist])
+
+    for flag, result in zip(flaglist, results):
         conf.start_msg("Checking for %s: %s" % (flagtype, flag))
-        try:
-            if flagtype == "cflags":
-                conf.check_cc(cflags=flag)
-            elif flagtype == "cxxflags":
-                conf.check_cxx(cxxflags=flag)
-            elif flagtype == "linkflags":
-                conf.check_cxx(linkflags=flag)
-        except conf.errors.ConfigurationError:
-            conf.end_msg("no", color="YELLOW")
-        else:
+        if result:
             conf.end_msg("yes")
             ret.append(flag)
+        else:
+            conf.end_msg("no", color="YELLOW")
 
     return ret
 
 
+def search_path_state(path_list):
+    """
+    Return the folders of a search path with their modification times. The
+    modification time of a folder changes when a program is added to it
+    or removed from it.
+
+    :param path_list: The list of folders (or a string separated by
+                      os.pathsep), the PATH is used if None
+    """
+    if path_list is None:
+        path_list = os.environ.get("PATH", "")
+    if isinstance(path_list, str):
+        path_list = path_list.split(os.pathsep)
+
+    state = []
+    for folder in path_list:
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            mtime = None
+        state.append([folder, mtime])
+
+    return state
+
+
+@conf
+def mkspec_find_program(conf, filename, path_list=None, var=None):
+    """
+    Find a program like conf.find_program, but the result is stored in the
+    user-level cache (see wurf_user_cache). A cached result is used as long
+    as the program and the folders of the search path are unchanged. A
+    program that was not found is also cached, so the missing compilers are
+    not searched again.
+
+    :param filename: The name of the program or a list of candidate names
+    :param path_list: The folders to search, the PATH is used if None
+    :param var: The environment variable that stores the program
+
+    :return: The program as a list
+    """
+    names = Utils.to_list(filename)
+    if not var:
+        var = re.sub(r"\W", "_", names[0].upper())
+
+    # The program can be given by an environment variable or it can be
+    # set already, which is handled by find_program
+    if not wurf_user_cache.is_enabled(conf) or var in os.environ or conf.env[var]:
+        return conf.find_program(filename, path_list=path_list, var=var)
+
+    # The cached result is replaced when a folder of the search path changes
+    state = search_path_state(path_list)
+    key = wurf_user_cache.make_key(names, [folder for folder, _ in state])
+    entry = wurf_user_cache.get("programs", key, state)
+
+    if entry and entry["path"] is None:
+        conf.msg("Checking for program %r" % ", ".join(names), False)
+        conf.fatal("Could not find the program %r (cached)" % names)
+
+    if entry and wurf_user_cache.file_identity(entry["path"][0]) == entry["file"]:
+        conf.msg("Checking for program %r" % ", ".join(names), " ".join(entry["path"]))
+        conf.to_log("Using cached program %r" % entry["path"])
+        conf.env[var] = entry["path"]
+        return entry["path"]
+
+    try:
+        program = conf.find_program(filename, path_list=path_list, var=var)
+    except conf.errors.ConfigurationError:
+        wurf_user_cache.put("programs", key, {"path": None, "file": None}, state)
+        raise
+
+    program = conf.cmd_to_list(program)
+    wurf_user_cache.put(
+        "programs",
+        key,
+        {"path": program, "file": wurf_user_cache.file_identity(program[0])},
+        state,
+    )
+    return program
+
+
+@conf
+def mkspec_get_cc_version(conf, compiler, gcc=False, clang=False):
+    """
+    Detect the compiler version and the target platform like
+    conf.get_cc_version, but the result is stored in the user-level cache
+    (see wurf_user_cache) until the compiler binary changes.
+
+    :param compiler: The compiler as a list
+    :param gcc: The compiler should be gcc, if true
+    :param clang: The compiler should be clang, if true
+    """
+    identity = wurf_user_cache.file_identity(compiler[0])
+    if not wurf_user_cache.is_enabled(conf) or identity is None:
+        conf.get_cc_version(cc=compiler, gcc=gcc, clang=clang)
+        return
+
+    key = wurf_user_cache.make_key(compiler, gcc, clang)
+    values = wurf_user_cache.get("cc_versions", key, identity)
+
+    if values is None:
+        # The version is detected in an empty environment, so that all
+        # the variables that are set by get_cc_version can be cached
+        env = conf.env
+        conf.env = ConfigSet.ConfigSet()
+        try:
+            conf.get_cc_version(cc=compiler, gcc=gcc, clang=clang)
+            values = conf.env.get_merged_dict()
+        finally:
+            conf.env = env
+
+        wurf_user_cache.put("cc_versions", key, values, identity)
+    else:
+        conf.to_log("Using cached version of %r" % compiler)
+
+    for name, value in values.items():
+        conf.env[name] = value
+
+
 @conf
 def mkspec_validate_cc_version(conf, major, minor, minimum=False):
     """
@@ -9,6 +9,8 @@ from waflib.Configure import conf
 
 from . import cxx_common
 
+import wurf_user_cache
+
 
 @conf
 def mkspec_emscripten_configure(conf, major, minor, minimum=False, force_debug=False):
@@ -21,10 +23,10 @@ def mkspec_emscripten_configure(conf, major, minor, minimum=False, force_debug=F
     paths = conf.get_tool_option("emscripten_path")
 
     # The node.js binary can be "nodejs" or simply "node"
-    conf.find_program(["nodejs", "node"], var="NODEJS")
+    conf.mkspec_find_program(["nodejs", "node"], var="NODEJS")
 
     # Find the clang++ compiler
-    cxx = conf.find_program(["em++"], path_list=paths)
+    cxx = conf.mkspec_find_program(["em++"], path_list=paths)
     cxx = conf.cmd_to_list(cxx)
     conf.env["CXX"] = cxx
     conf.env["CXX_NAME"] = os.path.basename(conf.env.get_flat("CXX"))
@@ -32,7 +34,7 @@ def mkspec_emscripten_configure(conf, major, minor, minimum=False, force_debug=F
     conf.check_emscripten_version(cxx, major, minor, minimum)
 
     # Find clang as the C compiler
-    cc = conf.find_program(["emcc"], path_list=paths)
+    cc = conf.mkspec_find_program(["emcc"], path_list=paths)
     cc = conf.cmd_to_list(cc)
     conf.env["CC"] = cc
     conf.env["CC_NAME"] = os.path.basename(conf.env.get_flat("CC"))
@@ -40,7 +42,7 @@ def mkspec_emscripten_configure(conf, major, minor, minimum=False, force_debug=F
     conf.check_emscripten_version(cc, major, minor, minimum)
 
     # Find the archiver
-    conf.find_program("emar", path_list=paths, var="AR")
+    conf.mkspec_find_program("emar", path_list=paths, var="AR")
     conf.env.ARFLAGS = ["rcs"]
 
     # Set up C++ tools and flags
@@ -103,8 +105,20 @@ def mkspec_emscripten_configure(conf, major, minor, minimum=False, force_debug=F
         conf.env["DEFINES"] += ["NDEBUG"]
 
 
-@conf
-def check_emscripten_version(conf, emscripten_cc, major, minor, minimum):
+def get_emscripten_version(conf, emscripten_cc):
+    """
+    Return the major and minor version of the Emscripten compiler. The
+    version is stored in the user-level cache (see wurf_user_cache) until
+    the compiler binary changes, since running the compiler is slow.
+    """
+    key = None
+    identity = wurf_user_cache.file_identity(emscripten_cc[0])
+    if wurf_user_cache.is_enabled(conf) and identity:
+        key = wurf_user_cache.make_key(emscripten_cc)
+        version = wurf_user_cache.get("emscripten_versions", key, identity)
+        if version:
+            return version
+
     try:
         p = subprocess.Popen(
             emscripten_cc + ["--version"],
@@ -116,6 +130,16 @@ def check_emscripten_version(conf, emscripten_cc, major, minor, minimum):
     except Exception as e:
         conf.fatal("Could not determine the compiler version: {}".format(e))
 
+    if key:
+        wurf_user_cache.put("emscripten_versions", key, [cc_major, cc_minor], identity)
+
+    return cc_major, cc_minor
+
+
+@conf
+def check_emscripten_version(conf, emscripten_cc, major, minor, minimum):
+    cc_major, cc_minor = get_emscripten_version(conf, emscripten_cc)
+
     cc_version = "{}.{}".format(cc_major, cc_minor)
 
     if minimum:
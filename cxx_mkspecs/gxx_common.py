@@ -20,7 +20,7 @@ def mkspec_check_gcc_version(conf, compiler, major, minor, minimum=False):
     :param minor: The minor version number, e.g. 6
     :param minimum: Only check for a minimum compiler version, if true
     """
-    conf.get_cc_version(cc=compiler, gcc=True)
+    conf.mkspec_get_cc_version(compiler, gcc=True)
     conf.mkspec_validate_cc_version(major, minor, minimum)
 
 
@@ -44,7 +44,7 @@ def mkspec_gxx_configure(conf, major, minor, prefix=None, minimum=False):
         gxx_names = conf.mkspec_get_compiler_binary_name("g++", major, minor, prefix)
         if minimum:
             gxx_names = "g++"
-        cxx = conf.find_program(gxx_names, path_list=paths)
+        cxx = conf.mkspec_find_program(gxx_names, path_list=paths)
         cxx = conf.cmd_to_list(cxx)
 
     conf.env["CXX"] = cxx
@@ -61,7 +61,7 @@ def mkspec_gxx_configure(conf, major, minor, prefix=None, minimum=False):
         gcc_names = conf.mkspec_get_compiler_binary_name("gcc", major, minor, prefix)
         if minimum:
             gcc_names = "gcc"
-        cc = conf.find_program(gcc_names, path_list=paths)
+        cc = conf.mkspec_find_program(gcc_names, path_list=paths)
         cc = conf.cmd_to_list(cc)
 
     conf.env["CC"] = cc
@@ -71,7 +71,7 @@ def mkspec_gxx_configure(conf, major, minor, prefix=None, minimum=False):
 
     # Find the archiver
     ar = conf.mkspec_get_ar_binary_name(prefix)
-    conf.find_program(ar, path_list=paths, var="AR")
+    conf.mkspec_find_program(ar, path_list=paths, var="AR")
     conf.env.ARFLAGS = "rcs"
 
     # Set up C++ tools and flags
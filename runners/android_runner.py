@@ -4,12 +4,64 @@
 import os
 import re
 
-from .basic_runner import BasicRunner
+from waflib import Utils
+
+from .basic_runner import BasicRunner, TargetPool, destination_lock, manifest_name
+
+# Guards the creation of the device pool
+poollock = Utils.threading.Lock()
+
+
+def get_device_pool(bld):
+    """
+    Return the pool of the Android devices that are used for running the
+    binaries. The devices are given by the device_id option (a comma
+    separated list) or device_pool=auto, which uses all devices that are
+    reported by 'adb devices'. If neither option is given, the pool only
+    contains the default device (None).
+    """
+    with poollock:
+        if hasattr(bld, "android_device_pool"):
+            return bld.android_device_pool
+
+        if bld.has_tool_option("device_pool"):
+            device_pool = bld.get_tool_option("device_pool")
+            if device_pool != "auto":
+                bld.fatal("Unknown device pool: {}".format(device_pool))
+
+            adb = bld.env.get_flat("ADB")
+            output = Utils.subprocess.check_output(
+                [adb, "devices"], universal_newlines=True
+            )
+            # The devices are listed as "<serial>\tdevice" after the header
+            devices = re.findall(r"^(\S+)\tdevice$", output, re.MULTILINE)
+            if not devices:
+                bld.fatal("No Android devices found with: {} devices".format(adb))
+        elif bld.has_tool_option("device_id"):
+            devices = bld.get_tool_option("device_id").split(",")
+        else:
+            devices = [None]
+
+        bld.android_device_pool = TargetPool(devices)
+        return bld.android_device_pool
 
 
 class AndroidRunner(BasicRunner):
+
+    sig_options = BasicRunner.sig_options + ["device_id", "device_pool"]
+
     def run(self):
 
+        # Run the binary on the first free device
+        device_pool = get_device_pool(self.generator.bld)
+        device_id = device_pool.acquire()
+        try:
+            self.run_attempts(self.run_on_device, device_id)
+        finally:
+            device_pool.release(device_id)
+
+    def run_on_device(self, device_id):
+
         bld = self.generator.bld
 
         adb = bld.env.get_flat("ADB")
@@ -18,10 +70,6 @@ class AndroidRunner(BasicRunner):
 
         dest_dir = "/data/local/tmp/"
 
-        device_id = None
-        if bld.has_tool_option("device_id"):
-            device_id = bld.get_tool_option("device_id")
-
         adb_shell = [adb]
         if device_id:
             adb_shell += ["-s", device_id]
@@ -32,31 +80,38 @@ class AndroidRunner(BasicRunner):
             adb_push += ["-s", device_id]
         adb_push += ["push"]
 
-        # Push the test files
-        for t in self.test_inputs:
+        # Push the test files and the binary
+        file_list = self.test_inputs + [self.inputs[0]]
+        binary = str(self.inputs[0].name)
 
-            filename = os.path.basename(t.abspath())
-            # This path is on android, hence we use '/'
-            # regardless of the host platform.
-            dest_file = dest_dir + filename
+        destination = "{0}:{1}".format(device_id, dest_dir)
 
-            result = self.run_cmd(adb_push + [t.abspath(), dest_file])
+        with destination_lock(destination):
 
-            results.append(result)
-            if result["return_code"] != 0:
-                self.save_result(results)
-                return
+            # Only push the files that changed since the last run
+            if bld.has_tool_option("run_sync"):
+                # A missing manifest is not an error, so the result is not
+                # stored
+                result = self.run_cmd(adb_shell + ["cat", dest_dir + manifest_name])
+                file_list, manifest = self.sync_manifest(
+                    file_list, result["stdout"], destination
+                )
+                if manifest:
+                    file_list.append(manifest)
 
-        # Push the binary
-        binary = str(self.inputs[0].name)
-        adb_push_bin = adb_push + [self.inputs[0].abspath(), dest_dir + binary]
+            for t in file_list:
 
-        result = self.run_cmd(adb_push_bin)
-        results.append(result)
+                filename = os.path.basename(t.abspath())
+                # This path is on android, hence we use '/'
+                # regardless of the host platform.
+                dest_file = dest_dir + filename
 
-        if result["return_code"] != 0:
-            self.save_result(results)
-            return
+                result = self.run_cmd(adb_push + [t.abspath(), dest_file])
+
+                results.append(result)
+                if result["return_code"] != 0:
+                    self.save_result(results)
+                    return
 
         run_binary_cmd = "./{0}".format(binary)
 
@@ -66,7 +121,8 @@ class AndroidRunner(BasicRunner):
         # Echo the exit code after the shell command
         result = self.run_cmd(
             adb_shell
-            + ["cd {0};{1};echo shellexit:$?".format(dest_dir, run_binary_cmd)]
+            + ["cd {0};{1};echo shellexit:$?".format(dest_dir, run_binary_cmd)],
+            self.remote_limits(),
         )
 
         results.append(result)
@@ -2,11 +2,78 @@
 # encoding: utf-8
 
 import os
+import re
 import sys
+import queue
+import stat
+import signal
+import time
 import shutil
+import hashlib
+import tempfile
 from waflib import Utils, Task, Logs
 
+from . import benchmark
+
 testlock = Utils.threading.Lock()
+# Makes sure that the buffered output of parallel run tasks is not interleaved
+printlock = Utils.threading.Lock()
+
+# The name of the manifest that lists the hashes of the files that were copied
+# to the destination folder on a target device (used with the run_sync option)
+manifest_name = ".wurf_manifest"
+
+# The locks that serialize copying files to the same destination folder
+destination_locks = {}
+destination_locks_lock = Utils.threading.Lock()
+
+# The locks that serialize staging a test file to the same target path,
+# since parallel run tasks can share test files (e.g. a shared library)
+staging_locks = {}
+staging_locks_lock = Utils.threading.Lock()
+
+# The hashes of the files that were already hashed during this build
+file_hashes = {}
+
+
+def destination_lock(destination):
+    """
+    Return the lock for copying files to the given destination folder on
+    a target device
+    """
+    with destination_locks_lock:
+        if destination not in destination_locks:
+            destination_locks[destination] = Utils.threading.Lock()
+        return destination_locks[destination]
+
+
+def staging_lock(target):
+    """
+    Return the lock for staging a test file to the given target path
+    """
+    with staging_locks_lock:
+        if target not in staging_locks:
+            staging_locks[target] = Utils.threading.Lock()
+        return staging_locks[target]
+
+
+def file_hash(path):
+    """
+    Return the SHA1 hash of a file as a hex string. The hash is only
+    computed once per build, unless the size or modification time of the
+    file changes.
+    """
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+
+    if key not in file_hashes:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha1.update(chunk)
+        file_hashes[key] = sha1.hexdigest()
+
+    return file_hashes[key]
 
 
 def nice_path(node):
@@ -17,6 +84,188 @@ def nice_path(node):
     return node.path_from(node.ctx.launch_node())
 
 
+def clone_file(source, target):
+    """
+    Copy the source file to the target path. On Linux, a copy-on-write
+    clone (reflink) is created if the file system supports it. Otherwise
+    shutil.copyfile is used, which avoids copying the data through user
+    space on the platforms that support it.
+    """
+    if sys.platform.startswith("linux"):
+        import fcntl
+
+        # The FICLONE ioctl from linux/fs.h
+        FICLONE = 0x40049409
+
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                # The file system does not support reflinks
+                pass
+
+    shutil.copyfile(source, target)
+
+
+def stage_file(source, target, mode=None):
+    """
+    Copy a test file to the target path, unless the target is already an
+    identical copy, i.e. it has the same size, modification time and mode.
+
+    The data is copied to a temporary file that is renamed to the target
+    path, so programs that still use the old target file are not affected.
+    Hard links are not used, since the tests might modify their input files.
+
+    :param source: the path to the source file
+    :param target: the path to the target file
+    :param mode: the file mode of the target file (optional)
+    :return: True if the file was copied, False if it was up-to-date
+    """
+    source_stat = os.stat(source)
+    try:
+        target_stat = os.stat(target)
+    except OSError:
+        pass
+    else:
+        if (
+            target_stat.st_size == source_stat.st_size
+            and target_stat.st_mtime_ns == source_stat.st_mtime_ns
+            and (mode is None or stat.S_IMODE(target_stat.st_mode) == mode)
+        ):
+            return False
+
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".staging")
+    os.close(fd)
+    try:
+        clone_file(source, temp)
+        # copystat also copies the modification time, which is used to
+        # detect an identical copy in the next build
+        shutil.copystat(source, temp)
+        if mode is not None:
+            os.chmod(temp, mode)
+        os.replace(temp, target)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+    return True
+
+
+def wait_process(proc):
+    """
+    Wait for a process to finish.
+
+    :return: the return code and the resource usage of the process, the
+             resource usage is None if os.wait4 is not available
+    """
+    if not hasattr(os, "wait4"):
+        return proc.wait(), None
+
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        return_code = -os.WTERMSIG(status)
+    else:
+        return_code = os.WEXITSTATUS(status)
+
+    # The process was reaped by os.wait4, so Popen must not wait for it
+    proc.returncode = return_code
+    return return_code, rusage
+
+
+def limit_tools(limits):
+    """
+    Return the names of the tools that limit_command uses to apply the
+    given limits
+
+    :param limits: the limits that are returned by BasicRunner.run_limits
+    """
+    if not sys.platform.startswith("linux"):
+        return []
+
+    tools = []
+    if "cpu_affinity" in limits:
+        tools.append("taskset")
+    if "max_rss" in limits:
+        tools.append("prlimit")
+    return tools
+
+
+def limit_command(cmd, limits):
+    """
+    Return the command that executes cmd with the memory limit and the CPU
+    affinity of the binary. The limits are applied by the prlimit and
+    taskset tools before the binary is executed, since a preexec_fn of
+    subprocess.Popen is not safe in the threads of the run tasks. The
+    limits are only applied on Linux (see limit_tools).
+
+    :param cmd: the command as a list of strings
+    :param limits: the limits that are returned by BasicRunner.run_limits
+    """
+    if not sys.platform.startswith("linux"):
+        return cmd
+
+    if "cpu_affinity" in limits:
+        cpus = ",".join(str(cpu) for cpu in limits["cpu_affinity"])
+        cmd = ["taskset", "-c", cpus] + cmd
+
+    if "max_rss" in limits:
+        # Linux does not enforce RLIMIT_RSS, so the address space is limited
+        size = int(limits["max_rss"] * 1024 * 1024)
+        cmd = ["prlimit", "--as={}".format(size), "--"] + cmd
+
+    return cmd
+
+
+def kill_process(proc):
+    """
+    Kill a process. If the process leads its own process group, all the
+    processes in the group are killed (e.g. the children of a test).
+    """
+    if proc.returncode is not None:
+        return
+
+    try:
+        if sys.platform != "win32" and os.getpgid(proc.pid) == proc.pid:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except PermissionError:
+                # The command was started with sudo, so the processes in
+                # the group are owned by root
+                Utils.subprocess.call(
+                    ["sudo", "-n", "kill", "-KILL", "--", "-{}".format(proc.pid)],
+                    stdout=Utils.subprocess.DEVNULL,
+                    stderr=Utils.subprocess.DEVNULL,
+                )
+        else:
+            proc.kill()
+    except OSError:
+        # The process already finished
+        pass
+
+
+class TargetPool(object):
+    """
+    A pool of target devices or hosts. A run task acquires a target for the
+    duration of the run, so the run tasks are distributed over the targets
+    and each target only runs one binary at a time.
+    """
+
+    def __init__(self, targets):
+        self.targets = list(targets)
+        self.free = queue.Queue()
+        for target in self.targets:
+            self.free.put(target)
+
+    def acquire(self):
+        """Return a free target, this blocks until a target is available"""
+        return self.free.get()
+
+    def release(self, target):
+        """Return a target to the pool"""
+        self.free.put(target)
+
+
 class BasicRunner(Task.Task):
 
     """
@@ -28,6 +277,40 @@ class BasicRunner(Task.Task):
     run_type = ""
     vars = []
 
+    # The tool options and environment variables that can change the outcome
+    # of a run. These are added to the task signature, which is used to skip
+    # the tasks that passed in a previous build (see the run_cached option).
+    sig_options = [
+        "run_cmd",
+        "benchmark_repeat",
+        "benchmark_warmup",
+        "benchmark_cpus",
+    ]
+    sig_environ = ["PATH", "LD_LIBRARY_PATH", "DYLD_LIBRARY_PATH"]
+
+    # The combined return code and the wall-clock time of the commands in
+    # the last run (set in save_result)
+    return_code = None
+    duration = None
+
+    # The status of the last run: "passed", "flaky" (passed after a retry)
+    # or "failed" (set in save_result)
+    status = None
+
+    # True if the run was skipped, because it passed with the same signature
+    # in a previous build (set in save_cached_result)
+    cached = False
+
+    # The output of the failed attempts of the current run, and whether a
+    # failed attempt is retried (see the run_retries option)
+    failed_attempts = []
+    retry_failure = False
+    retry_requested = False
+
+    # The statistical summary of the wall-clock times of a benchmark that was
+    # executed several times (set in run_binary)
+    benchmark_stats = None
+
     def __str__(self):
         "string to display to the user"
 
@@ -61,14 +344,170 @@ class BasicRunner(Task.Task):
 
     def runnable_status(self):
         """
-        Always execute the run task (even if the binary did not change)
+        Always execute the run task (even if the binary did not change),
+        unless the run_cached option is specified and the task passed
+        with the same signature in a previous build, or the number of
+        failed runs reached the limit given by the run_fail_fast or
+        run_max_failures option
         """
         ret = super(BasicRunner, self).runnable_status()
+
+        # Skip the remaining runs if too many runs failed already
+        if ret in (Task.RUN_ME, Task.SKIP_ME) and self.max_failures_reached():
+            self.save_cancelled_result()
+            return Task.SKIP_ME
+
         if ret == Task.SKIP_ME:
-            return Task.RUN_ME
+            if not self.use_cached_result():
+                return Task.RUN_ME
+
+            self.save_cached_result()
 
         return ret
 
+    def is_cached(self):
+        """
+        Return True if the run_cached option is specified and the task
+        passed with the same signature in a previous build, i.e. the task
+        will be skipped. The inputs of the task must be up-to-date.
+        """
+        if not self.use_cached_result():
+            return False
+
+        bld = self.generator.bld
+        return bld.task_sigs.get(self.uid()) == self.signature()
+
+    def use_cached_result(self):
+        """
+        Return True if a run that passed in a previous build can be skipped
+        (see the run_cached option). The benchmarks are always executed if
+        their times are saved or compared with a baseline, since a cached
+        run has no time.
+        """
+        bld = self.generator.bld
+        if not bld.has_tool_option("run_cached"):
+            return False
+
+        if self.run_type == "benchmark" and (
+            bld.has_tool_option("benchmark_save")
+            or bld.has_tool_option("benchmark_compare")
+        ):
+            return False
+
+        return True
+
+    def sig_vars(self):
+        """
+        Add the relevant tool options and environment variables to the
+        task signature
+        """
+        super(BasicRunner, self).sig_vars()
+
+        bld = self.generator.bld
+        values = []
+        for option in self.sig_options:
+            if bld.has_tool_option(option):
+                values.append(bld.get_tool_option(option))
+            else:
+                values.append(None)
+
+        values += [os.environ.get(var) for var in self.sig_environ]
+        values.append(sorted(self.run_limits().items()))
+        self.m.update(Utils.h_list(values))
+
+    def post_run(self):
+        """
+        Only store the task signature if the run passed, so that a failed
+        run is never skipped with the run_cached option
+        """
+        if self.return_code == 0:
+            super(BasicRunner, self).post_run()
+        else:
+            self.generator.bld.task_sigs.pop(self.uid(), None)
+
+    def max_failures_reached(self):
+        """
+        Return True if the number of failed runs reached the limit given by
+        the run_max_failures option (or one failure with run_fail_fast)
+        """
+        bld = self.generator.bld
+        if bld.has_tool_option("run_max_failures"):
+            max_failures = int(bld.get_tool_option("run_max_failures"))
+        elif bld.has_tool_option("run_fail_fast"):
+            max_failures = 1
+        else:
+            return False
+
+        with testlock:
+            return getattr(bld, "runner_failures", 0) >= max_failures
+
+    def save_cancelled_result(self):
+        """
+        Store the command of a task that was skipped, because too many runs
+        failed before it was started
+        """
+        cmd = self.format_command(self.inputs[0])
+        with printlock:
+            print("Cancelled: {} (too many failed runs)\n".format(cmd))
+
+        bld = self.generator.bld
+        with testlock:
+            if hasattr(bld, "runner_cancelled"):
+                bld.runner_cancelled.append(cmd)
+            else:
+                bld.runner_cancelled = [cmd]
+
+    def save_cached_result(self):
+        """
+        Store a passing result for a task that was skipped, because it
+        passed with the same signature in a previous build
+        """
+        cmd = self.format_command(self.inputs[0])
+        with printlock:
+            print("Skipping: {} (passed in a previous build)\n".format(cmd))
+
+        result = {
+            "cmd": cmd,
+            "return_code": 0,
+            "stdout": "Passed in a previous build (cached)\n",
+        }
+        # The result has no timing, so it must not replace the run history
+        self.cached = True
+        # Some runners override save_result with additional arguments
+        BasicRunner.save_result(self, [result])
+
+    def run_limits(self):
+        """
+        Return the limits of the binary that is executed by this task, i.e.
+        the timeout in seconds, the memory limit in megabytes and the CPUs
+        that the binary may run on. The timeout, max_rss and cpu_affinity
+        attributes of the task generator override the run_timeout and
+        run_mem_limit options.
+        """
+        bld = self.generator.bld
+        limits = {}
+
+        for key, option in [("timeout", "run_timeout"), ("max_rss", "run_mem_limit")]:
+            value = getattr(self.generator, key, None)
+            if value is None and bld.has_tool_option(option):
+                value = bld.get_tool_option(option)
+            if value is not None:
+                limits[key] = float(value)
+
+        cpu_affinity = getattr(self.generator, "cpu_affinity", None)
+        if cpu_affinity is not None:
+            limits["cpu_affinity"] = [int(cpu) for cpu in Utils.to_list(cpu_affinity)]
+
+        return limits
+
+    def remote_limits(self):
+        """
+        Return the limits of a binary that runs on a remote target. Only the
+        timeout applies, which kills the local SSH or ADB process.
+        """
+        limits = self.run_limits()
+        return {"timeout": limits["timeout"]} if "timeout" in limits else {}
+
     def format_command(self, executable):
         """
         Return a formatted command as a STRING
@@ -114,11 +553,52 @@ class BasicRunner(Task.Task):
         results are stored on ``self.generator.bld.runner_results`` for
         post processing.
         """
+        self.run_attempts(self.run_local)
+
+    def run_attempts(self, run_once, *args):
+        """
+        Call run_once(*args) to run the binary. A failed run is repeated up
+        to run_retries times, a run that passes after a retry is flaky. The
+        run is cancelled if the number of failed runs reached the limit
+        given by the run_fail_fast or run_max_failures option.
+        """
+        # The limit of failed runs may have been reached while this task
+        # waited for the run semaphore or for a free target
+        if self.max_failures_reached():
+            self.save_cancelled_result()
+            return
+
+        bld = self.generator.bld
+
+        retries = 0
+        if bld.has_tool_option("run_retries"):
+            retries = int(bld.get_tool_option("run_retries"))
+
+        self.failed_attempts = []
+        for attempt in range(retries + 1):
+            # save_result requests a retry if the attempt fails
+            self.retry_failure = attempt < retries
+            self.retry_requested = False
+
+            run_once(*args)
+
+            if not self.retry_requested:
+                break
+
+    def run_local(self):
+        """
+        Run the binary on the host
+        """
         bld = self.generator.bld
 
         # Then command string can be safely split into a list of strings
         binary = self.inputs[0].abspath()
         cmd = self.format_command_list(binary)
+
+        # Pin the benchmarks to the given CPUs to reduce the variance
+        if self.run_type == "benchmark" and bld.has_tool_option("benchmark_cpus"):
+            cmd = ["taskset", "-c", bld.get_tool_option("benchmark_cpus")] + cmd
+
         # If kernel objects are required, then run the test binary with sudo
         if self.kernel_objects:
             cmd.insert(0, "sudo")
@@ -128,14 +608,21 @@ class BasicRunner(Task.Task):
 
             test_file_out = self.inputs[0].parent.get_bld().make_node([t.name])
 
+            with staging_lock(test_file_out.abspath()):
+                copied = stage_file(
+                    t.abspath(),
+                    test_file_out.abspath(),
+                    getattr(self.generator, "chmod", None),
+                )
+
             Logs.debug(
-                "wr: test file {0} -> {1}".format(t.abspath(), test_file_out.abspath())
+                "wr: test file {0} -> {1} ({2})".format(
+                    t.abspath(),
+                    test_file_out.abspath(),
+                    "copied" if copied else "up-to-date",
+                )
             )
 
-            test_file_out.write(t.read("rb"), "wb")
-            if hasattr(self.generator, "chmod"):
-                os.chmod(test_file_out.abspath(), self.generator.chmod)
-
         results = []
 
         # Load the required kernel objects with insmod (in the original order)
@@ -145,8 +632,7 @@ class BasicRunner(Task.Task):
             results.append(result)
 
         # Run the test binary
-        result = self.run_cmd(cmd)
-        results.append(result)
+        results += self.run_binary(cmd)
 
         # Unload the required kernel objects with rmmod (in reverse order)
         for ko in reversed(self.kernel_objects):
@@ -170,12 +656,67 @@ class BasicRunner(Task.Task):
 
         self.save_result(results)
 
+    def run_binary(self, cmd):
+        """
+        Run the binary and return the results.
+
+        A benchmark is executed benchmark_warmup times without measuring it,
+        followed by benchmark_repeat measured runs. The statistical summary
+        of the measured wall-clock times is stored in self.benchmark_stats.
+        The runs stop at the first failure.
+        """
+        bld = self.generator.bld
+
+        if self.run_type != "benchmark" or not (
+            bld.has_tool_option("benchmark_repeat")
+            or bld.has_tool_option("benchmark_warmup")
+        ):
+            return [self.run_cmd(cmd, self.run_limits())]
+
+        warmup = 0
+        if bld.has_tool_option("benchmark_warmup"):
+            warmup = int(bld.get_tool_option("benchmark_warmup"))
+
+        repeat = 1
+        if bld.has_tool_option("benchmark_repeat"):
+            repeat = int(bld.get_tool_option("benchmark_repeat"))
+
+        limits = self.run_limits()
+
+        # The warmup runs are only reported if they fail
+        for _ in range(warmup):
+            result = self.run_cmd(cmd, limits)
+            if result["return_code"] != 0:
+                return [result]
+
+        results = []
+        for _ in range(repeat):
+            result = self.run_cmd(cmd, limits)
+            results.append(result)
+            if result["return_code"] != 0:
+                return results
+
+        self.benchmark_stats = benchmark.summarize(
+            [result["wall_time"] for result in results]
+        )
+        return results
+
     def save_result(self, results):
         """
         Stores the result in the self.generator.bld.runner_results
+
+        The result is a dict with the combined command output and return
+        code, and the timing and resource usage of the executed commands.
         """
         combined_stdout = u""
         combined_return_code = 0
+        combined_duration = 0.0
+        combined_user_time = 0.0
+        combined_sys_time = 0.0
+        combined_max_rss = 0
+        start = None
+        end = None
+        timed_out = False
 
         for result in results:
             cmd = result["cmd"]
@@ -195,11 +736,79 @@ class BasicRunner(Task.Task):
                 # Save the last non-zero return code
                 combined_return_code = result["return_code"]
 
-        combined_result = (
-            self.format_command(self.inputs[0]),
-            combined_return_code,
-            combined_stdout,
+            if result.get("timed_out"):
+                timed_out = True
+
+            # Only the commands that were executed have timing information
+            if "start" in result:
+                if start is None:
+                    start = result["start"]
+                end = result["end"]
+                combined_duration += result["wall_time"]
+
+            combined_user_time += result.get("user_time", 0.0)
+            combined_sys_time += result.get("sys_time", 0.0)
+            combined_max_rss = max(combined_max_rss, result.get("max_rss", 0))
+
+        # Retry a failed attempt, its output is kept for the final result
+        if combined_return_code != 0 and self.retry_failure:
+            self.failed_attempts.append(combined_stdout)
+            self.retry_requested = True
+            with printlock:
+                print(
+                    "Retrying: {} (attempt {} failed)\n".format(
+                        self.format_command(self.inputs[0]),
+                        len(self.failed_attempts),
+                    )
+                )
+            return
+
+        if combined_return_code != 0:
+            self.status = "failed"
+        elif self.failed_attempts:
+            self.status = "flaky"
+        else:
+            self.status = "passed"
+
+        # The output of the failed attempts comes before the final attempt
+        attempts_stdout = "".join(
+            "Attempt {} failed:\n{}\n".format(index + 1, stdout)
+            for index, stdout in enumerate(self.failed_attempts)
         )
+        combined_stdout = attempts_stdout + combined_stdout
+
+        self.return_code = combined_return_code
+        self.duration = combined_duration
+
+        combined_result = {
+            "name": self.inputs[0].name,
+            "run_type": self.run_type,
+            "cmd": self.format_command(self.inputs[0]),
+            "return_code": combined_return_code,
+            "status": self.status,
+            "attempts": len(self.failed_attempts) + 1,
+            "stdout": combined_stdout,
+            "start": start,
+            "end": end,
+            "wall_time": combined_duration,
+            "user_time": combined_user_time,
+            "sys_time": combined_sys_time,
+            "max_rss": combined_max_rss,
+            "timed_out": timed_out,
+            "cached": self.cached,
+        }
+
+        if self.benchmark_stats:
+            combined_result["benchmark"] = self.benchmark_stats
+
+        # Keep the results that are reported by the benchmark in a known
+        # output format (e.g. Google Benchmark JSON)
+        if self.run_type == "benchmark":
+            benchmark_results = benchmark.parse_output(
+                "\n".join(result["stdout"] or "" for result in results)
+            )
+            if benchmark_results:
+                combined_result["benchmark_results"] = benchmark_results
 
         testlock.acquire()
         try:
@@ -211,15 +820,79 @@ class BasicRunner(Task.Task):
             else:
                 bld.runner_results = [combined_result]
 
+            # Count the failed runs for the run_max_failures option
+            if combined_return_code != 0:
+                bld.runner_failures = getattr(bld, "runner_failures", 0) + 1
+
         finally:
             testlock.release()
 
-    def run_cmd(self, cmd):
+    def sync_manifest(self, nodes, manifest_output, destination):
+        """
+        Select the files that must be copied to a target device, based on
+        the manifest of the files that are already in the destination
+        folder (used with the run_sync option).
+
+        :param nodes: the nodes of the files that should be on the device
+        :param manifest_output: the output of reading the manifest on the
+                                device (which is empty if it does not exist)
+        :param destination: a name that identifies the destination folder,
+                            e.g. the host name and the folder
+        :return: the list of nodes that changed and the node of the updated
+                 manifest, which should be copied after these files (None
+                 if no files changed)
+        """
+        manifest = {}
+        for line in manifest_output.splitlines():
+            match = re.match(r"^([0-9a-f]{40})  (.+)$", line.strip())
+            if match:
+                manifest[match.group(2)] = match.group(1)
+
+        changed = []
+        for node in nodes:
+            digest = file_hash(node.abspath())
+            if manifest.get(node.name) != digest:
+                changed.append(node)
+                manifest[node.name] = digest
+
+        Logs.debug(
+            "wr: {0}/{1} files changed on {2}".format(
+                len(changed), len(nodes), destination
+            )
+        )
+
+        if not changed:
+            return [], None
 
         bld = self.generator.bld
-        run_silent = bld.has_tool_option("run_silent")
+        manifest_node = bld.bldnode.make_node(
+            ["run_sync", Utils.to_hex(Utils.h_list(destination)), manifest_name]
+        )
+        manifest_node.parent.mkdir()
+        manifest_node.write(
+            "".join(
+                "{0}  {1}\n".format(digest, name)
+                for name, digest in sorted(manifest.items())
+            )
+        )
+
+        return changed, manifest_node
+
+    def run_cmd(self, cmd, limits=None):
+        """
+        Run a command and return its result.
+
+        :param cmd: the command as a list of strings
+        :param limits: the limits of the command (see run_limits)
+        """
+        limits = limits or {}
+        kwargs = {}
 
-        print("Running: {}\n".format(cmd))
+        if limits and sys.platform != "win32":
+            # The command is started in a new process group, so the command
+            # and its children can be killed if the timeout expires
+            kwargs["start_new_session"] = True
+            cmd = limit_command(cmd, limits)
 
         proc = Utils.subprocess.Popen(
             cmd,
@@ -229,29 +902,113 @@ class BasicRunner(Task.Task):
             stdout=Utils.subprocess.PIPE,
             # stderr should go into the same handle as stdout:
             stderr=Utils.subprocess.STDOUT,
+            **kwargs
         )
 
-        all_stdout = []
-        # iter() is used to read lines as soon as they are written to
-        # work around the read-ahead bug in Python 2:
-        # https://bugs.python.org/issue3907
-        for line in iter(proc.stdout.readline, ""):
-            all_stdout.append(line)
-            if not run_silent:
-                print(line.rstrip())
-                sys.stdout.flush()
+        return self.read_output(proc, cmd, limits.get("timeout"))
+
+    def read_output(self, proc, cmd, timeout=None):
+        """
+        Read the output of a process started by run_cmd and wait for it
+        to finish.
+
+        The output is buffered and printed in one go when the process
+        finishes, so the output of parallel run tasks is not interleaved.
+        The run_stream option prints every line as soon as it is written.
+
+        The process is killed if it does not finish within the timeout
+        (in seconds).
+        """
+        bld = self.generator.bld
+        run_silent = bld.has_tool_option("run_silent")
+
+        start = time.time()
 
-        proc.stdout.close()
-        return_code = proc.wait()
+        timed_out = Utils.threading.Event()
+        timer = None
+        if timeout:
 
-        if return_code:
-            print("\nReturn code: {}\n".format(return_code))
+            def expire():
+                timed_out.set()
+                kill_process(proc)
+
+            timer = Utils.threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+
+        if bld.has_tool_option("run_stream"):
+            print("Running: {}\n".format(cmd))
+
+            all_stdout = []
+            # iter() is used to read lines as soon as they are written to
+            # work around the read-ahead bug in Python 2:
+            # https://bugs.python.org/issue3907
+            for line in iter(proc.stdout.readline, ""):
+                all_stdout.append(line)
+                if not run_silent:
+                    print(line.rstrip())
+                    sys.stdout.flush()
+
+            proc.stdout.close()
+            return_code, rusage = wait_process(proc)
+
+            if return_code:
+                print("\nReturn code: {}\n".format(return_code))
+
+            stdout = "".join(all_stdout)
+        else:
+            # Like communicate(), the input is closed and the output is
+            # read in large chunks
+            if proc.stdin:
+                proc.stdin.close()
+            stdout = proc.stdout.read()
+            proc.stdout.close()
+            return_code, rusage = wait_process(proc)
+
+            output = ["Running: {}\n\n".format(cmd)]
+            if stdout and not run_silent:
+                output.append(stdout if stdout.endswith("\n") else stdout + "\n")
+            if return_code:
+                output.append("\nReturn code: {}\n\n".format(return_code))
+
+            with printlock:
+                sys.stdout.write("".join(output))
+                sys.stdout.flush()
+
+        if timer:
+            timer.cancel()
 
-        stdout = "".join(all_stdout)
         if hasattr(stdout, "decode"):
             # This is needed in Python 2 to allow unicode output
             stdout = stdout.decode("utf-8")
 
-        result = {"cmd": cmd, "return_code": return_code, "stdout": stdout}
+        if timed_out.is_set():
+            timeout_msg = "Timeout: killed after {:g} seconds\n".format(timeout)
+            stdout += timeout_msg
+            with printlock:
+                sys.stdout.write("{}: {}\n".format(cmd, timeout_msg))
+                sys.stdout.flush()
+
+        end = time.time()
+
+        result = {
+            "cmd": cmd,
+            "return_code": return_code,
+            "stdout": stdout,
+            "start": start,
+            "end": end,
+            "wall_time": end - start,
+            "timed_out": timed_out.is_set(),
+        }
+
+        if rusage:
+            # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+            max_rss = rusage.ru_maxrss
+            if sys.platform == "darwin":
+                max_rss //= 1024
+
+            result["user_time"] = rusage.ru_utime
+            result["sys_time"] = rusage.ru_stime
+            result["max_rss"] = max_rss
 
         return result
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import math
+import statistics
+
+# The z-score of the 95% confidence level
+confidence_z = 1.96
+
+# The values that are kept from the benchmark output
+benchmark_keys = [
+    "iterations",
+    "real_time",
+    "cpu_time",
+    "time_unit",
+    "bytes_per_second",
+    "items_per_second",
+]
+
+
+def median_confidence_interval(values):
+    """
+    Return the 95% confidence interval of the median of the values.
+
+    The interval is given by two order statistics of the sorted values, so
+    it does not assume that the values are normally distributed. The ranks
+    are found with the normal approximation of the binomial distribution.
+    With less than 6 values, the interval spans all values.
+
+    :param values: the measured values
+    :return: the lower and upper bound of the interval
+    """
+    values = sorted(values)
+    n = len(values)
+
+    if n < 6:
+        return values[0], values[-1]
+
+    offset = confidence_z * math.sqrt(n) / 2.0
+    # The 1-based ranks of the lower and upper bound
+    lower = int(math.floor(n / 2.0 - offset))
+    upper = int(math.ceil(1 + n / 2.0 + offset))
+
+    return values[max(lower, 1) - 1], values[min(upper, n) - 1]
+
+
+def summarize(values):
+    """
+    Return the statistical summary of the measured values, i.e. the median,
+    the median absolute deviation (MAD) and the 95% confidence interval of
+    the median, which are robust to outliers caused by e.g. other processes
+    on the machine.
+
+    :param values: the measured values (e.g. the wall-clock times)
+    """
+    median = statistics.median(values)
+    mad = statistics.median([abs(value - median) for value in values])
+    ci_low, ci_high = median_confidence_interval(values)
+
+    return {
+        "repeat": len(values),
+        "min": min(values),
+        "max": max(values),
+        "mean": statistics.mean(values),
+        "median": median,
+        "mad": mad,
+        "ci_low": ci_low,
+        "ci_high": ci_high,
+    }
+
+
+def find_json_objects(output):
+    """
+    Return the JSON objects in the output of a program. An object must
+    start at the beginning of a line, the surrounding text is ignored.
+
+    :param output: the output of the program
+    """
+    decoder = json.JSONDecoder()
+    objects = []
+    index = 0
+
+    while True:
+        index = output.find("{", index)
+        if index < 0:
+            return objects
+
+        if index == 0 or output[index - 1] == "\n":
+            try:
+                obj, end = decoder.raw_decode(output, index)
+            except ValueError:
+                pass
+            else:
+                objects.append(obj)
+                index = end
+                continue
+
+        index += 1
+
+
+def parse_google_benchmark(obj):
+    """
+    Return the benchmarks in the output of a Google Benchmark binary
+    that is executed with --benchmark_format=json
+    """
+    if "context" not in obj or not isinstance(obj.get("benchmarks"), list):
+        return None
+
+    benchmarks = []
+    for entry in obj["benchmarks"]:
+        benchmark = {"name": entry["name"]}
+        for key in benchmark_keys:
+            if key in entry:
+                benchmark[key] = entry[key]
+        benchmarks.append(benchmark)
+
+    return benchmarks
+
+
+# The parsers of the supported output formats. A parser returns the list
+# of benchmarks in a JSON object, or None if the format is not recognized.
+parsers = {"google_benchmark": parse_google_benchmark}
+
+
+def parse_output(output):
+    """
+    Return the benchmarks that are found in the output of a program, keyed
+    by the benchmark name. If a benchmark is reported several times (e.g.
+    the program was executed with --benchmark_repeat), the entry with the
+    median real time is returned.
+
+    :param output: the output of the program
+    """
+    found = {}
+
+    for obj in find_json_objects(output):
+        for fmt, parser in sorted(parsers.items()):
+            benchmarks = parser(obj)
+            if benchmarks is None:
+                continue
+
+            for benchmark in benchmarks:
+                benchmark["format"] = fmt
+                found.setdefault(benchmark["name"], []).append(benchmark)
+            break
+
+    results = {}
+    for name, entries in found.items():
+        entries.sort(key=lambda entry: entry.get("real_time", 0.0))
+        results[name] = entries[(len(entries) - 1) // 2]
+
+    return results
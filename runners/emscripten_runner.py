@@ -5,6 +5,9 @@ from .basic_runner import BasicRunner
 
 
 class EmscriptenRunner(BasicRunner):
+
+    vars = ["NODEJS"]
+
     def format_command_list(self, executable):
         cmd = super(EmscriptenRunner, self).format_command_list(executable)
 
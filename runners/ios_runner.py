@@ -5,17 +5,29 @@ import os
 import time
 from waflib import Utils, Logs
 
-from .ssh_runner import SSHRunner
+from .basic_runner import TargetPool
+from .ssh_runner import SSHRunner, poollock
 
 
 class IOSRunner(SSHRunner):
-    def run(self):
+    def host_pool(self):
 
         bld = self.generator.bld
 
-        dest_dir = "/private/var/mobile/tmp"
+        # The device is connected to a local port, so there is only one host
+        with poollock:
+            if not hasattr(bld, "ios_host_pool"):
+                host = ("mobile@localhost", "/private/var/mobile/tmp")
+                bld.ios_host_pool = TargetPool([host])
+
+        return bld.ios_host_pool
+
+    def ssh_settings(self, host):
+
+        bld = self.generator.bld
+
+        ssh_target, dest_dir = host
         localport = "22222"
-        ssh_target = "mobile@localhost"
 
         ssh_options = []
         if bld.has_tool_option("ssh_options"):
@@ -25,8 +37,10 @@ class IOSRunner(SSHRunner):
         if bld.has_tool_option("scp_options"):
             scp_options = bld.get_tool_option("scp_options").replace('"', "").split(" ")
 
-        ssh_cmd = ["ssh", "-t", "-p", localport] + ssh_options + [ssh_target]
-        scp_cmd = ["scp", "-P", localport] + scp_options
+        multiplex_options = self.multiplex_options()
+
+        ssh_cmd = ["ssh", "-t", "-p", localport] + multiplex_options + ssh_options
+        ssh_cmd += [ssh_target]
+        scp_cmd = ["scp", "-P", localport] + multiplex_options + scp_options
 
-        # Call the 'run_ssh' method of the SSHRunner class
-        super(IOSRunner, self).run_ssh(ssh_cmd, scp_cmd, ssh_target, dest_dir)
+        return ssh_cmd, scp_cmd, ssh_target, dest_dir
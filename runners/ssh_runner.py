@@ -4,9 +4,17 @@
 import os
 import sys
 import re
-from waflib import Utils, Logs
+import shutil
+import tarfile
+import tempfile
+from waflib import Utils, Logs, Task
 
-from .basic_runner import BasicRunner
+from .basic_runner import BasicRunner, TargetPool, destination_lock, manifest_name
+
+# Guards the creation of the folder for the SSH control sockets
+controllock = Utils.threading.Lock()
+# Guards the creation of the host pool
+poollock = Utils.threading.Lock()
 
 
 def options(opt):
@@ -35,6 +43,16 @@ def options(opt):
         help="Set the target SSH host (used with --ssh_runner)",
     )
 
+    opts.add_option(
+        "--ssh_hosts",
+        default=None,
+        dest="ssh_hosts",
+        help="Distribute the binaries over several target hosts given as a "
+        "comma separated list of [user@]host[:dest_dir] entries, or as "
+        '"@file" with one entry per line (used with --ssh_runner and '
+        "--run_jobs)",
+    )
+
     opts.add_option(
         "--ssh_dest_dir",
         default=None,
@@ -52,6 +70,15 @@ def options(opt):
         "before running the binary (used with --ssh_runner)",
     )
 
+    opts.add_option(
+        "--ssh_deploy",
+        default=None,
+        dest="ssh_deploy",
+        action="store_true",
+        help="Copy the files of all binaries to the target host with a "
+        "single transfer before running them (used with --ssh_runner)",
+    )
+
     opts.add_option(
         "--ssh_output_file",
         default=None,
@@ -59,6 +86,15 @@ def options(opt):
         help="Save the console output to the given file " "(used with --ssh_runner)",
     )
 
+    opts.add_option(
+        "--ssh_multiplex",
+        default=None,
+        dest="ssh_multiplex",
+        action="store_true",
+        help="Reuse one SSH connection for all the commands that are sent to "
+        "the target host during the build (used with --ssh_runner)",
+    )
+
     opts.add_option(
         "--ssh_options",
         default=None,
@@ -74,13 +110,75 @@ def options(opt):
     )
 
 
+def get_host_pool(bld):
+    """
+    Return the pool of the SSH hosts that are used for running the binaries.
+    The hosts are given by the ssh_hosts option, or by the ssh_host option
+    if there is only one host. Each host is a tuple of the SSH target
+    (user@host) and the destination folder on that host.
+    """
+    with poollock:
+        if hasattr(bld, "ssh_host_pool"):
+            return bld.ssh_host_pool
+
+        if bld.has_tool_option("ssh_hosts"):
+            entries = bld.get_tool_option("ssh_hosts")
+            if entries.startswith("@"):
+                with open(os.path.expanduser(entries[1:]), "r") as f:
+                    entries = [e.strip() for e in f if e.strip()]
+                entries = [e for e in entries if not e.startswith("#")]
+            else:
+                entries = [e.strip() for e in entries.split(",") if e.strip()]
+        else:
+            entries = [bld.get_tool_option("ssh_host")]
+
+        hosts = []
+        for entry in entries:
+            ssh_target, _, dest_dir = entry.partition(":")
+            if "@" not in ssh_target:
+                ssh_target = bld.get_tool_option("ssh_user") + "@" + ssh_target
+            if not dest_dir:
+                dest_dir = bld.get_tool_option("ssh_dest_dir")
+            hosts.append((ssh_target, dest_dir))
+
+        bld.ssh_host_pool = TargetPool(hosts)
+        return bld.ssh_host_pool
+
+
+def close_ssh_connections(bld):
+    """
+    Close the SSH master connections that were opened during the build
+    (used with the ssh_multiplex option)
+    """
+    control_dir = getattr(bld, "ssh_control_dir", None)
+    if not control_dir:
+        return
+
+    for socket in os.listdir(control_dir):
+        control_path = os.path.join(control_dir, socket)
+        Logs.debug("ssh: closing master connection {}".format(control_path))
+        # The host name is ignored when the control path is explicit
+        Utils.subprocess.call(
+            ["ssh", "-o", "ControlPath={}".format(control_path)]
+            + ["-O", "exit", "localhost"],
+            stdout=Utils.subprocess.PIPE,
+            stderr=Utils.subprocess.STDOUT,
+        )
+
+    shutil.rmtree(control_dir, ignore_errors=True)
+
+
 class SSHRunner(BasicRunner):
-    def run_cmd(self, cmd):
 
-        bld = self.generator.bld
-        run_silent = bld.has_tool_option("run_silent")
+    sig_options = BasicRunner.sig_options + [
+        "ssh_user",
+        "ssh_host",
+        "ssh_hosts",
+        "ssh_dest_dir",
+        "ssh_options",
+    ]
 
-        print("Running: {}\n".format(cmd))
+    def run_cmd(self, cmd, limits=None):
 
         # The pty module only works on Unix systems
         stdin_target = Utils.subprocess.PIPE
@@ -105,30 +203,8 @@ class SSHRunner(BasicRunner):
             stderr=Utils.subprocess.STDOUT,
         )
 
-        all_stdout = []
-        # iter() is used to read lines as soon as they are written to
-        # work around the read-ahead bug in Python 2:
-        # https://bugs.python.org/issue3907
-        for line in iter(proc.stdout.readline, ""):
-            all_stdout.append(line)
-            if not run_silent:
-                print(line.rstrip())
-                sys.stdout.flush()
-
-        proc.stdout.close()
-        return_code = proc.wait()
-
-        if return_code:
-            print("\nReturn code: {}\n".format(return_code))
-
-        stdout = "".join(all_stdout)
-        if hasattr(stdout, "decode"):
-            # This is needed in Python 2 to allow unicode output
-            stdout = stdout.decode("utf-8")
-
-        result = {"cmd": cmd, "return_code": return_code, "stdout": stdout}
-
-        return result
+        # Only the timeout applies, since the command runs on the target
+        return self.read_output(proc, cmd, (limits or {}).get("timeout"))
 
     def save_result(self, results, ssh_cmd):
         # Override save_result to ensure that the kernel objects are removed
@@ -143,12 +219,30 @@ class SSHRunner(BasicRunner):
 
     def run(self):
 
+        # Run the binary on the first free host
+        host_pool = self.host_pool()
+        host = host_pool.acquire()
+        try:
+            self.run_attempts(self.run_ssh, *self.ssh_settings(host))
+        finally:
+            host_pool.release(host)
+
+    def host_pool(self):
+        """
+        Return the pool of the target hosts
+        """
+        return get_host_pool(self.generator.bld)
+
+    def ssh_settings(self, host):
+        """
+        Return the SSH command, the SCP command, the SSH target and the
+        destination folder for the given host
+
+        :param host: a host from the host pool
+        """
         bld = self.generator.bld
 
-        dest_dir = bld.get_tool_option("ssh_dest_dir")
-        ssh_host = bld.get_tool_option("ssh_host")
-        ssh_user = bld.get_tool_option("ssh_user")
-        ssh_target = ssh_user + "@" + ssh_host
+        ssh_target, dest_dir = host
 
         ssh_options = []
         if bld.has_tool_option("ssh_options"):
@@ -158,44 +252,157 @@ class SSHRunner(BasicRunner):
         if bld.has_tool_option("scp_options"):
             scp_options = bld.get_tool_option("scp_options").replace('"', "").split(" ")
 
-        ssh_cmd = ["ssh", "-t"] + ssh_options + [ssh_target]
-        scp_cmd = ["scp"] + scp_options
+        multiplex_options = self.multiplex_options()
 
-        self.run_ssh(ssh_cmd, scp_cmd, ssh_target, dest_dir)
+        ssh_cmd = ["ssh", "-t"] + multiplex_options + ssh_options + [ssh_target]
+        scp_cmd = ["scp"] + multiplex_options + scp_options
 
-    def run_ssh(self, ssh_cmd, scp_cmd, ssh_target, dest_dir):
+        return ssh_cmd, scp_cmd, ssh_target, dest_dir
 
+    def multiplex_options(self):
+        """
+        Return the SSH/SCP options that share one master connection per
+        target host during the build (used with the ssh_multiplex option)
+        """
+        bld = self.generator.bld
+        if not bld.has_tool_option("ssh_multiplex"):
+            return []
+
+        with controllock:
+            if not hasattr(bld, "ssh_control_dir"):
+                # The length of a socket path is limited, so the sockets are
+                # placed in a short temporary path instead of the build folder
+                # The connections are closed by close_ssh_connections, which
+                # is added as a post-build function in make_run
+                bld.ssh_control_dir = tempfile.mkdtemp(prefix="wurf-ssh-")
+
+        control_path = os.path.join(bld.ssh_control_dir, "%C")
+
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            "ControlPath={}".format(control_path),
+            # The master connections are closed after the build, but they
+            # also expire if the build is interrupted
+            "-o",
+            "ControlPersist=60",
+        ]
+
+    def deploy_files(self):
+        """
+        Return the nodes of the files that are copied to the target host
+        """
+        # The test files, the required kernel objects and the binary
+        return self.test_inputs + self.kernel_objects + [self.inputs[0]]
+
+    def copy_files(
+        self, ssh_cmd, scp_cmd, ssh_target, dest_dir, file_list, archive=None
+    ):
+        """
+        Copy the given files to the destination folder on the target host
+
+        :param file_list: the list of nodes that should be copied
+        :param archive: the node of a tar archive (optional). If specified,
+                        the files are packed into this archive, which is
+                        copied and extracted on the target host.
+        :return: the list of results, the last result indicates whether the
+                 files were copied successfully
+        """
         bld = self.generator.bld
 
         results = []
 
-        # Delete all files from the destination folder if requested
+        # Delete all files from the destination folder if requested. The
+        # glob does not match the hidden manifest of the run_sync option,
+        # so it is deleted explicitly and all files are copied again.
         if bld.has_tool_option("ssh_clean_dir"):
-            result = self.run_cmd(ssh_cmd + ["rm", "-rf", "{0}/*".format(dest_dir)])
+            result = self.run_cmd(
+                ssh_cmd
+                + ["rm", "-rf", "{0}/*".format(dest_dir)]
+                + ["{0}/{1}".format(dest_dir, manifest_name)]
+            )
             results.append(result)
 
         # Make sure the destination folder exists
         result = self.run_cmd(ssh_cmd + ["mkdir", "-p", "{0}".format(dest_dir)])
         results.append(result)
 
-        # Enumerate the test files
-        file_list = [test_input.abspath() for test_input in self.test_inputs]
+        destination = "{0}:{1}".format(ssh_target, dest_dir)
+
+        with destination_lock(destination):
+
+            # Only copy the files that changed since the last run
+            if bld.has_tool_option("run_sync"):
+                # A missing manifest is not an error, so the result is not
+                # stored
+                result = self.run_cmd(
+                    ssh_cmd + ["cat {0}/{1}".format(dest_dir, manifest_name)]
+                )
+                file_list, manifest = self.sync_manifest(
+                    file_list, result["stdout"], destination
+                )
+                if not file_list:
+                    return results
+
+                file_list = file_list + [manifest]
+
+            if archive:
+                # The files are extracted to the destination folder without
+                # their paths (like with SCP)
+                with tarfile.open(archive.abspath(), "w") as tar:
+                    for node in file_list:
+                        tar.add(node.abspath(), arcname=node.name)
+                file_list = [archive]
+
+            # Copy all files in file_list
+            file_list = [node.abspath() for node in file_list]
+            result = self.run_cmd(scp_cmd + file_list + [ssh_target + ":" + dest_dir])
+            results.append(result)
 
-        # Add the required kernel objects
-        for ko in self.kernel_objects:
-            file_list.append(ko.abspath())
+            if archive and result["return_code"] == 0:
+                result = self.run_cmd(
+                    ssh_cmd
+                    + ["cd {0};tar -xf {1};rm {1}".format(dest_dir, archive.name)]
+                )
+                results.append(result)
+
+        return results
+
+    def run_ssh(self, ssh_cmd, scp_cmd, ssh_target, dest_dir):
+
+        bld = self.generator.bld
+
+        results = []
 
-        # Add the binary
         binary = self.inputs[0]
-        file_list.append(binary.abspath())
 
-        # Copy all files in file_list
-        result = self.run_cmd(scp_cmd + file_list + [ssh_target + ":" + dest_dir])
-        results.append(result)
+        deploy_tasks = getattr(self, "deploy_tasks", {})
+        deploy_task = deploy_tasks.get((ssh_target, dest_dir))
+        if deploy_task:
+            # The files were already copied by the deploy task
+            if deploy_task.return_code != 0:
+                error_msg = "The files could not be deployed to the target\n"
+                print(error_msg)
+
+                result = {
+                    "cmd": "Checking the deployed files",
+                    "return_code": -1,
+                    "stdout": error_msg,
+                }
+
+                results.append(result)
+                self.save_result(results, ssh_cmd)
+                return
+        else:
+            copy_results = self.copy_files(
+                ssh_cmd, scp_cmd, ssh_target, dest_dir, self.deploy_files()
+            )
+            results += copy_results
 
-        if result["return_code"] != 0:
-            self.save_result(results, ssh_cmd)
-            return
+            if copy_results[-1]["return_code"] != 0:
+                self.save_result(results, ssh_cmd)
+                return
 
         # Load the required kernel objects with insmod (in the original order)
         # Note: you have to SSH with the ROOT user!
@@ -225,7 +432,8 @@ class SSHRunner(BasicRunner):
                     "cd {0};{1} &> {2};echo shellexit:$? >> {2}".format(
                         dest_dir, run_binary_cmd, output_file
                     )
-                ]
+                ],
+                self.remote_limits(),
             )
             results.append(result)
             failed_run = result["return_code"] != 0
@@ -251,7 +459,8 @@ class SSHRunner(BasicRunner):
             # Echo the exit code after the shell command
             result = self.run_cmd(
                 ssh_cmd
-                + ["cd {0};{1};echo shellexit:$?".format(dest_dir, run_binary_cmd)]
+                + ["cd {0};{1};echo shellexit:$?".format(dest_dir, run_binary_cmd)],
+                self.remote_limits(),
             )
             results.append(result)
 
@@ -323,3 +532,124 @@ class SSHRunner(BasicRunner):
                 return
 
         self.save_result(results, ssh_cmd)
+
+
+class SSHDeploy(SSHRunner):
+    """
+    Copy the files of all the SSH run tasks in a build group to the target
+    host with a single transfer (used with the ssh_deploy option)
+    """
+
+    def __str__(self):
+        "string to display to the user"
+
+        ssh_cmd, scp_cmd, ssh_target, dest_dir = self.settings
+        return "{name}: {count} files -> {target}:{dest_dir}\n".format(
+            name=self.__class__.__name__,
+            count=len(getattr(self, "deploy_nodes", self.inputs)),
+            target=ssh_target,
+            dest_dir=dest_dir,
+        )
+
+    def runnable_status(self):
+        """
+        Deploy the files of the run tasks that are executed, i.e. the run
+        tasks that are not skipped with the run_cached option. The
+        deployment is skipped if all the run tasks are skipped.
+        """
+        ret = Task.Task.runnable_status(self)
+        if ret not in (Task.RUN_ME, Task.SKIP_ME):
+            return ret
+
+        self.deploy_nodes = []
+        for task in self.run_tasks:
+            if task.is_cached():
+                continue
+            for node in task.deploy_files():
+                if node not in self.deploy_nodes:
+                    self.deploy_nodes.append(node)
+
+        if not self.deploy_nodes:
+            self.return_code = 0
+            return Task.SKIP_ME
+
+        return Task.RUN_ME
+
+    def run(self):
+
+        ssh_cmd, scp_cmd, ssh_target, dest_dir = self.settings
+
+        # Pack all files into one archive
+        archive = self.generator.bld.bldnode.make_node(
+            "ssh_deploy_{}.tar".format(self.deploy_index)
+        )
+
+        results = self.copy_files(
+            ssh_cmd, scp_cmd, ssh_target, dest_dir, self.deploy_nodes, archive
+        )
+
+        self.save_result(results, ssh_cmd)
+
+    def save_result(self, results, ssh_cmd):
+        """
+        Only store the result if the deployment failed, the deployment
+        is not a run in itself
+        """
+        self.return_code = 0
+        for result in results:
+            if result["return_code"] != 0:
+                self.return_code = result["return_code"]
+
+        if self.return_code != 0:
+            BasicRunner.save_result(self, results)
+
+
+def make_deploy(taskgen, task):
+    """
+    Add the files of an SSH run task to the deploy tasks of the current build
+    group, the deploy tasks are created if needed (used with the ssh_deploy
+    option)
+    """
+    bld = taskgen.bld
+
+    if not hasattr(bld, "ssh_deploy_tasks"):
+        bld.ssh_deploy_tasks = {}
+
+    # The run task can run on any host in the pool, so the files are deployed
+    # to every host
+    task.deploy_tasks = {}
+
+    for host in task.host_pool().targets:
+
+        # The files are deployed separately for each build group, since the
+        # run tasks of a group only wait for the binaries of that group
+        key = (task.__class__.__name__, bld.current_group, host)
+        deploy = bld.ssh_deploy_tasks.get(key)
+
+        if not deploy:
+            deploy = taskgen.create_task("SSHDeploy")
+            deploy.settings = task.ssh_settings(host)
+            deploy.deploy_index = len(bld.ssh_deploy_tasks)
+            deploy.test_inputs = []
+            deploy.kernel_objects = []
+            deploy.run_tasks = []
+            # The deployed files by name, since they are copied to one folder
+            deploy.deploy_names = {}
+            bld.ssh_deploy_tasks[key] = deploy
+
+        # Shared libraries and test files are often used by several binaries,
+        # but they are only transferred once
+        for node in task.deploy_files():
+            other = deploy.deploy_names.get(node.name)
+            if other is None:
+                deploy.inputs.append(node)
+                deploy.deploy_names[node.name] = node
+            elif other.abspath() != node.abspath():
+                bld.fatal(
+                    "Cannot deploy {} and {} to the same folder, since the "
+                    "files have the same name".format(other.abspath(), node.abspath())
+                )
+
+        deploy.run_tasks.append(task)
+        task.deploy_tasks[host] = deploy
+        task.set_run_after(deploy)
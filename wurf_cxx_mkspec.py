@@ -1,18 +1,48 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
+import sys
+
+from waflib import ConfigSet
+from waflib import Logs
+from waflib import Options
 from waflib import Utils
+from waflib import Build
 from waflib.Configure import conf
+from waflib.Configure import ConfigurationContext
+
+import wurf_user_cache
 
+import cxx_mkspecs.cxx_common
 import cxx_mkspecs.cxx_default
 import cxx_mkspecs.clang_mkspecs
 import cxx_mkspecs.gxx_mkspecs
 import cxx_mkspecs.msvc_mkspecs
 import cxx_mkspecs.emscripten_mkspecs
 
+# The modules that define the mkspecs
+mkspec_modules = [
+    cxx_mkspecs.cxx_default,
+    cxx_mkspecs.clang_mkspecs,
+    cxx_mkspecs.gxx_mkspecs,
+    cxx_mkspecs.msvc_mkspecs,
+    cxx_mkspecs.emscripten_mkspecs,
+]
+
 # Allows us to catch queries for platforms that we do not yet support
 mkspec_platforms = ["windows", "linux", "android", "mac", "ios", "emscripten"]
 
+# The options that change which mkspecs can be configured
+mkspec_path_options = [
+    "android_sdk_dir",
+    "android_ndk_dir",
+    "ios_sdk_dir",
+    "ios_toolchain_dir",
+    "emscripten_path",
+    "poky_sdk_path",
+]
+
 
 @conf
 def get_mkspec_platform(conf):
@@ -109,6 +139,25 @@ def options(opt):
         '(use the ";" character between flags)',
     )
 
+    opts.add_option(
+        "--cxx_no_cache",
+        default=None,
+        dest="cxx_no_cache",
+        action="store_true",
+        help="Do not use the user-level cache of the compiler checks "
+        "(stored in $XDG_CACHE_HOME/wurf or ~/.cache/wurf)",
+    )
+
+    opts.add_option(
+        "--probe_all_cxx_stds",
+        default=None,
+        dest="probe_all_cxx_stds",
+        action="store_true",
+        help="Check all C++ standards and store the supported ones in "
+        "CXX_SUPPORTED_STDS (by default, only the standard that is requested "
+        "by the project is checked)",
+    )
+
     opts.add_option(
         "--android_sdk_dir",
         default=None,
@@ -188,5 +237,121 @@ def configure(conf):
         mkspecs = [a for a in dir(conf) if a.startswith("cxx_")]
         conf.fatal(f"Unknown mkspec: {mkspec}, available mkspecs: {', '.join(mkspecs)}")
 
-    # Check which versions of the C++ standard are supported by the compiler
-    conf.check_cxx_std()
+    # The C++ standards are checked with the flags of the mkspec, and not
+    # with the flags that are added by the project later (e.g. -Werror)
+    conf.env["CXX_STD_CHECK_FLAGS"] = {
+        "CXXFLAGS": list(conf.env["CXXFLAGS"]),
+        "LINKFLAGS": list(conf.env["LINKFLAGS"]),
+    }
+
+    # Only the C++ standard that is requested by the project is checked
+    # after the recursion (see wurf_cxx_version), unless all standards
+    # should be checked
+    if conf.has_tool_option("probe_all_cxx_stds"):
+        conf.check_cxx_std()
+
+
+def mkspec_names():
+    """
+    Return the names of the mkspecs, i.e. the cxx_* functions that are
+    defined in the mkspec modules. The methods of the ConfigurationContext
+    cannot be used, since waf also defines e.g. cxx_load_tools and the
+    methods that are added with @conf are wrappers from waflib.Configure.
+    """
+    return sorted(
+        name
+        for module in mkspec_modules
+        for name, value in vars(module).items()
+        if name.startswith("cxx_")
+        and callable(value)
+        and value.__module__ == module.__name__
+    )
+
+
+class ListMkspecsContext(ConfigurationContext):
+    """lists the mkspecs that can be configured on this machine"""
+
+    cmd = "list_mkspecs"
+
+    def execute(self):
+        self.init_dirs()
+
+        self.cachedir = self.bldnode.make_node(Build.CACHE_DIR)
+        self.cachedir.mkdir()
+
+        path = os.path.join(self.bldnode.abspath(), "list_mkspecs.log")
+        self.logger = Logs.make_logger(path, "cfg")
+
+        mkspecs = mkspec_names()
+
+        # The index of the mkspecs is stored in the user-level cache, it is
+        # valid until a program is added to or removed from the PATH
+        options = Options.options.__dict__
+        key = wurf_user_cache.make_key(
+            sys.platform,
+            mkspecs,
+            [options.get(option) for option in mkspec_path_options],
+        )
+        state = cxx_mkspecs.cxx_common.search_path_state(None)
+
+        use_cache = not options.get("cxx_no_cache")
+        index = wurf_user_cache.get("mkspecs", key, state) if use_cache else None
+
+        if index is None:
+            index = {}
+            for mkspec in mkspecs:
+                Logs.info("Checking {} ...".format(mkspec))
+                index[mkspec] = self.probe_mkspec(mkspec)
+
+            if use_cache:
+                wurf_user_cache.put("mkspecs", key, index, state)
+        else:
+            Logs.info("Using the cached mkspec index")
+
+        available = [mkspec for mkspec in mkspecs if index[mkspec]["available"]]
+        Logs.pprint("CYAN", "Available mkspecs %d/%d:" % (len(available), len(mkspecs)))
+        for mkspec in available:
+            Logs.pprint(
+                "GREEN",
+                "  %-40s %s (%s)"
+                % (mkspec, index[mkspec]["compiler"], index[mkspec]["version"]),
+            )
+
+        Logs.info("The configure log is written to: {}".format(path))
+
+    def probe_mkspec(self, mkspec):
+        """
+        Configure a mkspec with a fresh environment and return whether it
+        is available with its compiler and compiler version
+        """
+        self.env = ConfigSet.ConfigSet()
+        self.env["stored_options"] = Options.options.__dict__.copy()
+
+        # The messages of the checks are not printed
+        def no_msg(*k, **kw):
+            pass
+
+        old_msg = self.msg
+        old_start_msg = self.start_msg
+        old_end_msg = self.end_msg
+
+        self.msg = self.start_msg = self.end_msg = no_msg
+
+        self.to_log("Checking the mkspec: {}".format(mkspec))
+        try:
+            getattr(self, mkspec)()
+        except Exception as e:
+            # A broken toolchain should not stop the listing, so any error
+            # makes the mkspec unavailable
+            self.to_log("The mkspec {} is not available: {}".format(mkspec, e))
+            return {"available": False, "error": str(e)}
+        finally:
+            self.msg = old_msg
+            self.start_msg = old_start_msg
+            self.end_msg = old_end_msg
+
+        return {
+            "available": bool(self.env["CXX"]),
+            "compiler": self.env.get_flat("CXX"),
+            "version": ".".join(str(v) for v in self.env["CC_VERSION"]),
+        }
@@ -5,6 +5,10 @@ from waflib import Errors
 from waflib.Configure import conf
 from waflib.Configure import ConfigurationContext
 
+import wurf_user_cache
+
+# Provides the mkspec_check_parallel method
+import cxx_mkspecs.cxx_common
 
 # List of supported C++ stds
 cxx_stds = ["c++98", "c++03", "c++11", "c++14", "c++17", "c++20", "c++23", "c++26"]
@@ -36,6 +40,12 @@ def configure(conf):
                 self.msg("No C++ standard specified", "ok", color="YELLOW")
                 return
             origin = conf.env["CXX_STD_ORIGIN"]
+
+            # Only the requested standard is checked, unless all standards
+            # were checked already (see the probe_all_cxx_stds option)
+            if cxx_std not in self.env["CXX_SUPPORTED_STDS"]:
+                self.check_cxx_std([cxx_std])
+
             self.start_msg(f"Using {cxx_std.upper()} (required by {origin})")
 
             # Check that the std is supported by the compiler
@@ -66,50 +76,126 @@ def get_cxx_std_flags(compiler, version, cxx_std):
         raise Errors.WafError(f"Unknown compiler: {compiler} {version}")
 
 
+def cxx_std_check_flags(conf):
+    """
+    Return the C++ and linker flags of the C++ standard checks, i.e. the
+    flags that were set by the mkspec (see wurf_cxx_mkspec). The current
+    flags are used if the mkspec was not configured.
+    """
+    flags = conf.env["CXX_STD_CHECK_FLAGS"]
+    if flags:
+        return flags
+
+    return {"CXXFLAGS": conf.env["CXXFLAGS"], "LINKFLAGS": conf.env["LINKFLAGS"]}
+
+
+def cxx_std_check_env(conf):
+    """
+    Return the environment of a C++ standard check
+    """
+    flags = cxx_std_check_flags(conf)
+
+    env = conf.env.derive()
+    env["CXXFLAGS"] = list(flags["CXXFLAGS"])
+    env["LINKFLAGS"] = list(flags["LINKFLAGS"])
+    return env
+
+
+def cxx_std_cache_entry(conf):
+    """
+    Return the key and the state of the C++ standard checks in the
+    user-level cache, or None if the compiler binary is not found. The
+    result of the checks only depends on the compiler binary, its version
+    and the flags of the mkspec. The entry of a compiler and its flags is
+    replaced when the compiler binary or its version changes.
+    """
+    identity = wurf_user_cache.file_identity(conf.env["CXX"][0])
+    if identity is None:
+        return None
+
+    flags = cxx_std_check_flags(conf)
+    key = wurf_user_cache.make_key(
+        conf.env["CXX"],
+        flags["CXXFLAGS"],
+        flags["LINKFLAGS"],
+    )
+    return key, [identity, conf.env["CC_VERSION"]]
+
+
 @conf
-def check_cxx_std(conf):
+def check_cxx_std(conf, stds=None):
     """
     Check which C++ standard is supported by the set compiler.
     This will populate the environment variable CXX_SUPPORTED_STDS
     with the list of supported C++ standards and their corresponding flags
     for enabling them.
+
+    :param stds: the C++ standards to check, all standards are checked
+                 if None. The results are added to CXX_SUPPORTED_STDS.
+
+    The checks use the flags of the mkspec, so the flags that are added by
+    the project do not change the results. The results are stored in a
+    user-level cache (see wurf_user_cache), so the checks are only executed
+    once for each compiler and set of flags.
     """
     compiler = conf.env["CXX"][0]
     version = conf.env["CC_VERSION"]
 
-    conf.env["CXX_SUPPORTED_STDS"] = {}
-
-    # monkey patch start_msg and end_msg to avoid printing
-    # the messages to the console
-    def start_msg(self, *k, **kw):
-        pass
-
-    def end_msg(self, *k, **kw):
-        pass
+    check_all = stds is None
+    if check_all:
+        stds = cxx_stds
+
+    supported = dict(conf.env["CXX_SUPPORTED_STDS"] or {})
+
+    # Maps each checked C++ standard to its flag (None if not supported)
+    cache_entry = None
+    checked = {}
+    if wurf_user_cache.is_enabled(conf):
+        cache_entry = cxx_std_cache_entry(conf)
+    if cache_entry:
+        checked = wurf_user_cache.get("cxx_stds", *cache_entry) or {}
+
+    # The first flag of each standard is checked in parallel, the alias
+    # flags are only checked for the standards whose first flag failed
+    pending = [cxx_std for cxx_std in stds if cxx_std not in checked]
+    probed = bool(pending)
+    flags = {}
+    for cxx_std in pending:
+        flags[cxx_std] = get_cxx_std_flags(compiler, version, cxx_std)
+        checked[cxx_std] = None
+
+    index = 0
+    while pending:
+        results = conf.mkspec_check_parallel(
+            "cxx",
+            [
+                {"cxxflags": flags[cxx_std][index], "env": cxx_std_check_env(conf)}
+                for cxx_std in pending
+            ],
+        )
+        for cxx_std, ret in zip(pending, results):
+            if ret:
+                checked[cxx_std] = flags[cxx_std][index]
 
-    # cache the original start_msg and end_msg
-    old_start_msg = conf.start_msg
-    old_end_msg = conf.end_msg
+        index += 1
+        pending = [
+            cxx_std
+            for cxx_std in pending
+            if not checked[cxx_std] and index < len(flags[cxx_std])
+        ]
 
-    conf.start_msg = start_msg
-    conf.end_msg = end_msg
+    for cxx_std in stds:
+        if checked[cxx_std]:
+            supported[cxx_std] = checked[cxx_std]
 
-    for cxx_std in cxx_stds:
-        cxx_std_flags = get_cxx_std_flags(compiler, version, cxx_std)
-        for cxx_std_flag in cxx_std_flags:
-            ret = conf.check_cxx(
-                cxxflags=cxx_std_flag,
-                mandatory=False,
-            )
-            if ret:
-                conf.env["CXX_SUPPORTED_STDS"][cxx_std] = cxx_std_flag
-                break
+    conf.env["CXX_SUPPORTED_STDS"] = supported
 
-    # restore the original start_msg and end_msg
-    conf.start_msg = old_start_msg
-    conf.end_msg = old_end_msg
+    if cache_entry and probed:
+        key, state = cache_entry
+        wurf_user_cache.put("cxx_stds", key, checked, state)
 
-    if conf.env["CXX_SUPPORTED_STDS"] == {}:
+    # A single unsupported standard is reported by post_recurse
+    if check_all and not supported:
         conf.fatal(
             f"Could not determine the C++ standards supported by {compiler} {version}."
         )
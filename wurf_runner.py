@@ -36,24 +36,140 @@ def build(bld):
                 source     = ['main.cpp'],
                 target     = 'hello',
                 test_files = ['test_input.txt'])
+
+By default, the run tasks are executed sequentially. The '--run_jobs=N'
+option allows up to N tests or benchmarks to run in parallel (N is capped
+by the number of waf jobs, see '-j'). Programs that set the 'run_serial'
+attribute are executed one after another, and no other program runs at the
+same time:
+
+def build(bld):
+    bld.program(features   = 'cxx test',
+                source     = ['main.cpp'],
+                target     = 'hello',
+                run_serial = True)
+
+Programs that use an exclusive resource (e.g. a network port or a device)
+can list it in the 'run_resources' attribute. The programs that share a
+resource are executed one after another, while the other programs still
+run in parallel. The programs that load a kernel module implicitly use the
+'kmod:<module>' resource:
+
+def build(bld):
+    bld.program(features      = 'cxx test',
+                source        = ['main.cpp'],
+                target        = 'hello',
+                run_resources = ['port:5000', 'device:eth1'])
+
+The '--run_timeout' and '--run_mem_limit' options limit the wall-clock time
+(in seconds) and the address space (in megabytes) of every program. The
+memory limit caps the address space (RLIMIT_AS), not the resident memory
+(RSS), so it breaks the programs that reserve a large address space (e.g.
+with ASan or TSan). A task generator can set its own limits and the CPUs
+that the program may run on (the memory limit and the CPU affinity only
+apply to local runs on Linux, where they are applied with prlimit and
+taskset, which must be installed):
+
+def build(bld):
+    bld.program(features     = 'cxx test',
+                source       = ['main.cpp'],
+                target       = 'hello',
+                timeout      = 60,
+                max_rss      = 512,
+                cpu_affinity = [0, 1])
+
+When the '--run_jobs' option is used, the programs that failed in the
+previous build are started first, followed by the programs that took the
+longest time to run. The run history is stored in the build folder.
+
+The '--run_retries=N' option runs a failed program up to N more times. The
+programs that pass after a retry are reported as flaky, and the number of
+flaky runs of each program is stored in the run history.
+
+The '--test_filter' option only compiles the test source files that match
+one of the given patterns (e.g. '--test_filter=codec*,decoder'). The tests
+without matching source files are neither compiled nor run. The filter only
+applies to the C++ source files with 'test' in their name (e.g.
+'codec_test.cpp'). The other source files (e.g. helpers, C files or
+generated files) and the files with the entry point of a test are always
+compiled, i.e. 'main.cpp', the files named '*_main.cpp' and the files in
+the 'test_main' attribute:
+
+def build(bld):
+    bld.program(features  = 'cxx test',
+                source    = ['runner.cpp', 'codec_test.cpp'],
+                target    = 'hello',
+                test_main = ['runner.cpp'])
+
+The '--run_shard=I/N' option splits the programs into N shards by a hash of
+their path and only runs shard I, so several machines can each run a part
+of the tests. The reports of the shards (see '--run_report') can be merged.
+
+The '--benchmark_repeat=N' option runs each benchmark N times (after
+'--benchmark_warmup=K' unmeasured runs) and prints the median, the median
+absolute deviation and the 95% confidence interval of the median of the
+wall-clock time. The '--benchmark_cpus' option pins the benchmarks to the
+given CPUs with taskset.
+
+The '--benchmark_save=name' option stores the wall-clock times of the
+benchmarks as a named baseline in the build folder. The
+'--benchmark_compare=name' option fails the build if a benchmark is slower
+than in the baseline by more than '--benchmark_threshold' (default: 5%).
+
+The results that are printed by the benchmarks in a known format (e.g.
+Google Benchmark with '--benchmark_format=json') are stored in one file in
+the build folder and summarized after the build.
 """
 
 import os
+import re
+import json
+import zlib
+import heapq
+import shutil
+import fnmatch
+import itertools
+import xml.etree.ElementTree as ElementTree
 
 from waflib import Errors
 from waflib import Logs
+from waflib import Task
 from waflib import Utils
-from waflib.TaskGen import feature, after_method
+from waflib.TaskGen import feature, after_method, before_method
 
 from runners.android_runner import AndroidRunner
-from runners.basic_runner import BasicRunner
+from runners.basic_runner import BasicRunner, limit_tools
 from runners.ios_runner import IOSRunner
-from runners.ssh_runner import SSHRunner
+from runners.ssh_runner import SSHRunner, close_ssh_connections, make_deploy
 from runners.emscripten_runner import EmscriptenRunner
 
 # We keep a list of the run tasks so that we can execute them sequentially
 run_tasks = []
 
+# The last run task that uses each exclusive resource (see run_resources)
+resource_tasks = {}
+
+# The file in the build folder that stores the wall-clock time and the result
+# of each program in the previous builds
+run_history_file = "run_history.json"
+
+# The folder in the build folder that stores the benchmark baselines
+benchmark_baseline_folder = "benchmark_baselines"
+
+# The file in the build folder that stores the results that are reported by
+# the benchmarks in this build (e.g. in the Google Benchmark JSON format)
+benchmark_results_file = "benchmark_results.json"
+
+# The control characters that are not allowed in XML documents
+xml_invalid_chars = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# The extensions of the C++ source files that the test_filter option applies to
+test_source_extensions = [".cpp", ".cc", ".cxx"]
+
+# The weight that is added to the programs that failed in the previous build,
+# so they are started before all other programs
+failed_weight = 1000000
+
 
 def options(opt):
 
@@ -75,6 +191,92 @@ def options(opt):
         help="Do not print the test output on success " "(used with --run_tests)",
     )
 
+    opts.add_option(
+        "--run_stream",
+        default=None,
+        dest="run_stream",
+        action="store_true",
+        help="Print the output of the running programs line by line instead "
+        "of printing the whole output when a program finishes",
+    )
+
+    opts.add_option(
+        "--run_jobs",
+        default=None,
+        dest="run_jobs",
+        type="int",
+        help="Run up to N tests or benchmarks in parallel, at most as many as "
+        "the number of waf jobs (-j). Programs that set run_serial=True run "
+        "alone, and programs that share a resource in run_resources run one "
+        "after another",
+    )
+
+    opts.add_option(
+        "--run_fail_fast",
+        default=None,
+        dest="run_fail_fast",
+        action="store_true",
+        help="Skip the remaining tests and benchmarks after the first failed run",
+    )
+
+    opts.add_option(
+        "--run_max_failures",
+        default=None,
+        dest="run_max_failures",
+        type="int",
+        help="Skip the remaining tests and benchmarks after N failed runs",
+    )
+
+    opts.add_option(
+        "--run_shard",
+        default=None,
+        dest="run_shard",
+        help='Only run the tests and benchmarks in shard I of N (e.g. "2/8"), '
+        "the programs are assigned to the shards by a hash of their path",
+    )
+
+    opts.add_option(
+        "--run_retries",
+        default=None,
+        dest="run_retries",
+        type="int",
+        help="Run a failed test or benchmark up to N more times, a program "
+        "that passes after a retry is reported as flaky",
+    )
+
+    opts.add_option(
+        "--run_timeout",
+        default=None,
+        dest="run_timeout",
+        type="float",
+        help="Kill the tests and benchmarks that run longer than the given "
+        "number of seconds (the timeout attribute of a task generator "
+        "overrides this option)",
+    )
+
+    opts.add_option(
+        "--run_mem_limit",
+        default=None,
+        dest="run_mem_limit",
+        type="int",
+        help="Limit the address space (RLIMIT_AS) of the tests and benchmarks "
+        "to the given number of megabytes. This is not a limit on the "
+        "resident memory (RSS), so it breaks the binaries that are built "
+        "with ASan or TSan (the max_rss attribute of a task generator "
+        "overrides this option)",
+    )
+
+    opts.add_option(
+        "--run_cached",
+        default=None,
+        dest="run_cached",
+        action="store_true",
+        help="Skip the programs that passed in a previous build if the "
+        "program, its test files and the run command did not change (the "
+        "benchmarks are always executed with --benchmark_save and "
+        "--benchmark_compare)",
+    )
+
     opts.add_option(
         "--run_benchmarks",
         default=None,
@@ -90,6 +292,56 @@ def options(opt):
         help="Run a specific benchmark",
     )
 
+    opts.add_option(
+        "--benchmark_repeat",
+        default=None,
+        dest="benchmark_repeat",
+        type="int",
+        help="Run each benchmark N times and print the median, the median "
+        "absolute deviation and the 95% confidence interval of the "
+        "wall-clock time",
+    )
+
+    opts.add_option(
+        "--benchmark_warmup",
+        default=None,
+        dest="benchmark_warmup",
+        type="int",
+        help="Run each benchmark K times before the measured runs "
+        "(used with --benchmark_repeat)",
+    )
+
+    opts.add_option(
+        "--benchmark_cpus",
+        default=None,
+        dest="benchmark_cpus",
+        help='Pin the benchmarks to the given CPUs with taskset (e.g. "2" or "2,3")',
+    )
+
+    opts.add_option(
+        "--benchmark_save",
+        default=None,
+        dest="benchmark_save",
+        help="Store the wall-clock times of the benchmarks as the baseline "
+        "with the given name in the build folder",
+    )
+
+    opts.add_option(
+        "--benchmark_compare",
+        default=None,
+        dest="benchmark_compare",
+        help="Fail the build if a benchmark is slower than in the baseline "
+        "with the given name (see --benchmark_save)",
+    )
+
+    opts.add_option(
+        "--benchmark_threshold",
+        default="5%",
+        dest="benchmark_threshold",
+        help='The allowed slowdown compared to the baseline (default: "5%") '
+        "(used with --benchmark_compare)",
+    )
+
     opts.add_option(
         "--print_benchmarks",
         default=None,
@@ -133,7 +385,35 @@ def options(opt):
         default=None,
         dest="device_id",
         help="Specify the ID of the target Android device "
-        "(used with ADB when multiple devices are available)",
+        "(used with ADB when multiple devices are available). "
+        "A comma separated list of IDs distributes the binaries "
+        "over these devices (used with --run_jobs)",
+    )
+
+    opts.add_option(
+        "--device_pool",
+        default=None,
+        dest="device_pool",
+        help='Use "auto" to distribute the binaries over all Android devices '
+        'that are listed by "adb devices" (used with --run_jobs)',
+    )
+
+    opts.add_option(
+        "--run_sync",
+        default=None,
+        dest="run_sync",
+        action="store_true",
+        help="Only copy the files that changed since the last run to the "
+        "target device (used with --ssh_runner and on Android)",
+    )
+
+    opts.add_option(
+        "--run_report",
+        default=None,
+        dest="run_report",
+        help="Write the results of the runs to the given file, the results "
+        "are written in the JUnit XML format if the file name ends with "
+        '".xml" and in the JSON format otherwise',
     )
 
     opts.add_option(
@@ -141,16 +421,87 @@ def options(opt):
         default=None,
         dest="test_filter",
         help="Only compile the test source files that include the specified "
-        "substring (wildcards are allowed)",
+        "substring (wildcards are allowed, multiple patterns are separated "
+        "by commas). The tests without matching source files are not built. "
+        "Only the C++ files with 'test' in their name are filtered, and the "
+        "main.cpp and *_main.cpp files and the files in the test_main "
+        "attribute are always compiled",
     )
 
     opt.load("runners.ssh_runner")
 
 
+@feature("test")
+@before_method("process_source")
+def filter_test_sources(self):
+    """
+    Only keep the test source files that match the test_filter option. The
+    other source files are always kept (see is_test_source), e.g. helpers,
+    generated files and the source files with the entry point of the test
+    binary, i.e. main.cpp, the files named *_main.cpp and the files in the
+    test_main attribute. If no test source file matches, the test is
+    neither compiled, linked nor run.
+    """
+    if not self.bld.has_tool_option("test_filter"):
+        return
+
+    mains = self.to_nodes(getattr(self, "test_main", []))
+
+    patterns = [
+        "*{}*".format(pattern.strip())
+        for pattern in self.bld.get_tool_option("test_filter").split(",")
+        if pattern.strip()
+    ]
+
+    sources = []
+    matched = False
+    for node in self.to_nodes(getattr(self, "source", [])):
+        if node in mains or not is_test_source(node):
+            sources.append(node)
+            continue
+
+        path = node.path_from(self.path).replace("\\", "/")
+        if any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns):
+            sources.append(node)
+            matched = True
+
+    self.source = sources
+    self.test_filtered = not matched
+
+
+def is_main_source(node):
+    """
+    Return True if the name of a source file marks it as the entry point of
+    a test binary, i.e. main.cpp or *_main.cpp (with any file extension)
+    """
+    name = os.path.splitext(node.name)[0]
+    return name == "main" or name.endswith("_main")
+
+
+def is_test_source(node):
+    """
+    Return True if the test_filter option applies to a source file, i.e. a
+    C++ file in the source folder with 'test' in its name that is not the
+    entry point of a test binary (see is_main_source)
+    """
+    name, ext = os.path.splitext(node.name)
+    return (
+        ext in test_source_extensions
+        and "test" in name.lower()
+        and not is_main_source(node)
+        and not node.is_bld()
+    )
+
+
 @feature("test")
 @after_method("process_use")
 @after_method("apply_link")
 def make_test(self):
+    # Drop the compile and link tasks of a test that was filtered out
+    if getattr(self, "test_filtered", False):
+        self.tasks = []
+        return
+
     if self.bld.has_tool_option("run_tests"):
         make_run(self, "test")
 
@@ -205,7 +556,7 @@ def make_run(taskgen, run_type):
 
     There can be only one unit test task by task generator.
     """
-    if hasattr(taskgen, "link_task"):
+    if hasattr(taskgen, "link_task") and in_run_shard(taskgen):
 
         if taskgen.bld.has_tool_option("ssh_runner"):
             task = taskgen.create_task("SSHRunner", taskgen.link_task.outputs)
@@ -218,6 +569,27 @@ def make_run(taskgen, run_type):
         else:
             task = taskgen.create_task("BasicRunner", taskgen.link_task.outputs)
 
+        task.run_type = run_type
+
+        # The programs that run on the host need the tools that apply the
+        # run limits (the remote runners only apply the timeout)
+        if not isinstance(task, (SSHRunner, AndroidRunner)):
+            check_run_tools(taskgen.bld, task)
+
+        if taskgen.bld.has_tool_option("run_max_failures"):
+            if int(taskgen.bld.get_tool_option("run_max_failures")) < 1:
+                taskgen.bld.fatal("The run_max_failures option must be positive")
+
+        if taskgen.bld.has_tool_option("run_retries"):
+            if int(taskgen.bld.get_tool_option("run_retries")) < 0:
+                taskgen.bld.fatal("The run_retries option must not be negative")
+
+        if run_type == "benchmark":
+            check_benchmark_options(taskgen.bld)
+            # Parse the threshold before running the benchmarks
+            if taskgen.bld.has_tool_option("benchmark_compare"):
+                benchmark_threshold(taskgen.bld)
+
         # Check if the executable requires any test files
         test_files = getattr(taskgen, "test_files", [])
         task.test_inputs = to_source_nodes(test_files, taskgen.path)
@@ -248,17 +620,55 @@ def make_run(taskgen, run_type):
                     # Add the library to the test inputs
                     task.test_inputs.append(lib_node)
 
-        # Make sure that this newly created task is executed after the
-        # previously defined run task (if there is such a task)
-        if len(run_tasks) > 0:
-            task.set_run_after(run_tasks[-1])
-        # Store this task in the run_tasks list
-        run_tasks.append(task)
-
         # Check if the executable requires any kernel modules
         kernel_modules = getattr(taskgen, "kernel_modules", [])
         task.kernel_objects = []
 
+        # Tasks that request serial execution are always chained, all other
+        # tasks are only chained if the run_jobs option is not specified
+        run_serial = getattr(taskgen, "run_serial", False)
+        parallel = taskgen.bld.has_tool_option("run_jobs")
+
+        if run_serial or not parallel:
+            # Make sure that this newly created task is executed after the
+            # previously defined run task (if there is such a task)
+            if len(run_tasks) > 0:
+                task.set_run_after(run_tasks[-1])
+            # Store this task in the run_tasks list
+            run_tasks.append(task)
+
+        # Tasks that share an exclusive resource are executed one after
+        # another, e.g. the tasks that load the same kernel module
+        run_resources = Utils.to_list(getattr(taskgen, "run_resources", [])) + [
+            "kmod:" + module for module in kernel_modules
+        ]
+
+        for resource in run_resources:
+            if resource in resource_tasks:
+                task.set_run_after(resource_tasks[resource])
+            resource_tasks[resource] = task
+
+        if parallel:
+            # The semaphore limits the number of concurrent run tasks, and a
+            # serial task does not run at the same time as any other run task
+            task.semaphore = get_run_semaphore(taskgen.bld)
+            task.run_exclusive = run_serial
+
+            # Start the programs that failed in the previous build first,
+            # then the programs that take the longest time to run. The
+            # weight orders the ready tasks and the tasks that wait for the
+            # run semaphore (see RunQueue).
+            history = get_run_history(taskgen.bld).get(run_history_key(task))
+            if history:
+                task.weight = history["duration"]
+                if history["failed"]:
+                    task.weight += failed_weight
+
+        # Store the task for saving the run history after the build
+        if not hasattr(taskgen.bld, "runner_tasks"):
+            taskgen.bld.runner_tasks = []
+        taskgen.bld.runner_tasks.append(task)
+
         for module in kernel_modules:
             # Find the task that builds the module
             module_task = taskgen.bld.get_tgen_by_name(module).tasks[0]
@@ -267,19 +677,469 @@ def make_run(taskgen, run_type):
             # Make sure that the tests run after building the kernel module
             task.set_run_after(module_task)
 
+        # The test inputs and kernel objects must be part of the task
+        # signature if the results of the passing runs are cached
+        if taskgen.bld.has_tool_option("run_cached"):
+            task.dep_nodes.extend(task.test_inputs + task.kernel_objects)
+
+        # Copy the files of all SSH run tasks with a single transfer
+        if isinstance(task, SSHRunner) and taskgen.bld.has_tool_option("ssh_deploy"):
+            make_deploy(taskgen, task)
+
     # We are creating a new task which should run an executable after
     # a build finishes. Here we add two functions to the BuildContext
     # which prints a summary and ensures that the build fails if the
     # test fails.
-    post_funs = getattr(taskgen.bld, "post_funs", None)
-    if post_funs:
-        if set_exit_code not in post_funs:
-            taskgen.bld.add_post_fun(set_exit_code)
-        if summary not in post_funs:
-            taskgen.bld.add_post_fun(summary)
+    # The SSH connections are closed, and the run history and the report
+    # are saved before set_exit_code, which fails the build if any of the
+    # tests failed. The benchmark baseline is only saved if all runs passed
+    # and no benchmark regressed.
+    post_funs = getattr(taskgen.bld, "post_funs", None) or []
+    for fun in [
+        close_ssh_connections,
+        save_run_history,
+        write_report,
+        save_benchmark_results,
+        set_exit_code,
+        save_benchmark_baseline,
+        summary,
+    ]:
+        if fun not in post_funs:
+            taskgen.bld.add_post_fun(fun)
+
+
+def in_run_shard(taskgen):
+    """
+    Return True if the program of the task generator belongs to the shard
+    given by the run_shard option (or if the option is not used). The shard
+    is given by a stable hash of the path of the program in the build
+    folder, so every machine assigns the programs to the same shards.
+    """
+    bld = taskgen.bld
+    if not bld.has_tool_option("run_shard"):
+        return True
+
+    run_shard = bld.get_tool_option("run_shard")
+    try:
+        index, count = [int(x) for x in run_shard.split("/")]
+    except ValueError:
+        index, count = 0, 0
+
+    if not 1 <= index <= count:
+        bld.fatal('The run_shard option must be "I/N" with 1 <= I <= N')
+
+    path = taskgen.link_task.outputs[0].path_from(bld.bldnode)
+    return zlib.crc32(path.replace("\\", "/").encode("utf-8")) % count == index - 1
+
+
+@Utils.run_once
+def find_run_tool(name):
+    """
+    Return the path of a tool that is used to run the programs, or None if
+    the tool is not found in the PATH
+    """
+    return shutil.which(name)
+
+
+def check_run_tools(bld, task):
+    """
+    Check that the tools that apply the limits of a local run task are
+    installed, so a missing tool stops the build with a clear error instead
+    of failing every run
+    """
+    tools = limit_tools(task.run_limits())
+
+    # The benchmarks are pinned to the given CPUs with taskset
+    if task.run_type == "benchmark" and bld.has_tool_option("benchmark_cpus"):
+        tools.append("taskset")
+
+    for tool in tools:
+        if not find_run_tool(tool):
+            bld.fatal(
+                "The {} tool is required to apply the run limits of {} (it "
+                "is part of util-linux), but it was not found in the "
+                "PATH".format(tool, task.generator.name)
+            )
+
+
+def check_benchmark_options(bld):
+    """
+    Check that the number of benchmark runs is valid
+    """
+    if bld.has_tool_option("benchmark_repeat"):
+        if int(bld.get_tool_option("benchmark_repeat")) < 1:
+            bld.fatal("The benchmark_repeat option must be a positive integer")
+
+    if bld.has_tool_option("benchmark_warmup"):
+        if int(bld.get_tool_option("benchmark_warmup")) < 0:
+            bld.fatal("The benchmark_warmup option must not be negative")
+
+
+class RunQueue(object):
+    """
+    The run tasks that wait for a free slot of the run semaphore. The tasks
+    are returned in the order of their priority, i.e. the task with the
+    highest weight first (the order of the task generators breaks ties).
+    """
+
+    def __init__(self):
+        self.heap = []
+        # Keeps the insertion order of the tasks with the same priority
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, task):
+        weight, order = task.priority()
+        heapq.heappush(self.heap, (-weight, -order, next(self.counter), task))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[-1]
+
+    def peek(self):
+        """Return the task that is returned by the next pop()"""
+        return self.heap[0][-1]
+
+
+def is_exclusive(task):
+    """
+    Return True if the run task must not run at the same time as any
+    other run task (see the run_serial attribute)
+    """
+    return getattr(task, "run_exclusive", False)
+
+
+class RunSemaphore(Task.TaskSemaphore):
+    """
+    The semaphore of the run tasks. The waiting tasks are kept in a
+    RunQueue, since waf releases the tasks that wait in a
+    Task.TaskSemaphore in an arbitrary order.
+
+    An exclusive task takes all the slots of the semaphore. When it is the
+    next waiting task, the semaphore is locked until the running tasks have
+    finished, so the exclusive task is not overtaken by the tasks with a
+    lower priority.
+    """
+
+    def __init__(self, num):
+        super(RunSemaphore, self).__init__(num)
+        self.waiting = RunQueue()
+
+    def exclusive_waiting(self, task):
+        """
+        Return True if an exclusive task with a higher priority than the
+        given task is the next waiting task
+        """
+        if not self.waiting:
+            return False
+        first = self.waiting.peek()
+        return is_exclusive(first) and first.priority() > task.priority()
+
+    def is_locked(self):
+        if len(self.locking) >= self.num:
+            return True
+        if not self.locking:
+            return False
+        if any(is_exclusive(task) for task in self.locking):
+            return True
+        return bool(self.waiting) and is_exclusive(self.waiting.peek())
+
+    def acquire(self, tsk):
+        # A task that is taken from the waiting queue always succeeds here,
+        # since the Runner only does so if the semaphore is not locked
+        if (
+            len(self.locking) >= self.num
+            or self.locking
+            and (is_exclusive(tsk) or any(is_exclusive(t) for t in self.locking))
+            or self.exclusive_waiting(tsk)
+        ):
+            raise IndexError("Cannot lock more %r" % self.locking)
+        self.locking.add(tsk)
+
+
+def get_run_semaphore(bld):
+    """
+    Return the semaphore that is shared by all run tasks. The semaphore is
+    created on the first call with the number of slots given by the
+    run_jobs option.
+    """
+    if not hasattr(bld, "run_semaphore"):
+        run_jobs = int(bld.get_tool_option("run_jobs"))
+        if run_jobs < 1:
+            bld.fatal("The run_jobs option must be a positive integer")
+
+        # waf never runs more than -j tasks at the same time
+        jobs = getattr(bld, "jobs", run_jobs)
+        if run_jobs > jobs:
+            Logs.warn(
+                "Only {0} of the {1} run jobs can run in parallel, use -j{1} "
+                "to run more programs at the same time".format(jobs, run_jobs)
+            )
+        bld.run_semaphore = RunSemaphore(run_jobs)
+
+    return bld.run_semaphore
+
+
+def run_history_key(task):
+    """
+    Return the key of a run task in the run history, i.e. the path of the
+    binary in the build folder
+    """
+    return task.inputs[0].path_from(task.generator.bld.bldnode)
+
+
+def get_run_history(bld):
+    """
+    Return the run history, which maps each binary to the wall-clock time
+    and the result of its last run
+    """
+    if not hasattr(bld, "run_history"):
+        bld.run_history = {}
+        node = bld.bldnode.find_node(run_history_file)
+        if node:
+            try:
+                bld.run_history = json.loads(node.read())
+            except ValueError:
+                Logs.warn("Ignoring invalid run history: {}".format(node.abspath()))
+
+    return bld.run_history
+
+
+def save_run_history(bld):
+    """
+    Store the wall-clock time and the result of the programs that were
+    executed in this build in the run history. The history also counts the
+    runs of each program and how many of these runs were flaky.
+    """
+    history = get_run_history(bld)
+
+    for task in getattr(bld, "runner_tasks", []):
+        # The duration is not set if the task was skipped, and a cached run
+        # keeps the history of the build where the program was executed
+        if task.duration is None or task.cached:
+            continue
+
+        key = run_history_key(task)
+        previous = history.get(key, {})
+
+        history[key] = {
+            "duration": task.duration,
+            "failed": task.return_code != 0,
+            "runs": previous.get("runs", 0) + 1,
+            "flaky": previous.get("flaky", 0) + (task.status == "flaky"),
+        }
+
+    node = bld.bldnode.make_node(run_history_file)
+    node.write(json.dumps(history, indent=2, sort_keys=True))
+
+
+def benchmark_threshold(bld):
+    """
+    Return the allowed relative slowdown of the benchmarks, e.g. 0.05 for
+    the "5%" threshold
+    """
+    threshold = bld.get_tool_option("benchmark_threshold")
+    try:
+        value = float(threshold.rstrip("%")) / 100.0
+    except ValueError:
+        value = -1.0
+
+    if value < 0:
+        bld.fatal("Invalid benchmark threshold: {}".format(threshold))
+
+    return value
+
+
+def benchmark_time(result):
+    """
+    Return the wall-clock time of a benchmark result, i.e. the median if
+    the benchmark was executed several times
+    """
+    if "benchmark" in result:
+        return result["benchmark"]["median"]
+    return result["wall_time"]
+
+
+def benchmark_baseline_node(bld, name):
+    """
+    Return the node of the benchmark baseline with the given name
+    """
+    folder = bld.bldnode.make_node(benchmark_baseline_folder)
+    return folder.make_node(name + ".json")
+
+
+def save_benchmark_baseline(bld):
+    """
+    Store the wall-clock times of the benchmarks as the baseline given by
+    the benchmark_save option. The benchmarks that were not executed in
+    this build keep their times from the previous baseline.
+    """
+    if not bld.has_tool_option("benchmark_save"):
+        return
+
+    node = benchmark_baseline_node(bld, bld.get_tool_option("benchmark_save"))
+
+    baseline = {}
+    if node.exists():
+        try:
+            baseline = json.loads(node.read())
+        except ValueError:
+            Logs.warn("Replacing invalid benchmark baseline: {}".format(node))
+
+    for result in getattr(bld, "runner_results", []):
+        if result["run_type"] != "benchmark" or result["return_code"]:
+            continue
+
+        baseline[result["name"]] = {
+            "time": benchmark_time(result),
+            "benchmark": result.get("benchmark"),
+        }
+
+    node.parent.mkdir()
+    node.write(json.dumps(baseline, indent=2, sort_keys=True))
+    Logs.pprint("CYAN", "Saved the benchmark baseline: {}".format(node))
+
+
+def benchmark_regressions(bld):
+    """
+    Compare the benchmarks with the baseline given by the benchmark_compare
+    option.
+
+    :return: a message for each benchmark that is slower than the baseline
+             by more than the benchmark threshold
+    """
+    name = bld.get_tool_option("benchmark_compare")
+    node = benchmark_baseline_node(bld, name)
+    if not node.exists():
+        bld.fatal("The benchmark baseline does not exist: {}".format(node))
+
+    try:
+        baseline = json.loads(node.read())
+    except ValueError:
+        bld.fatal("Invalid benchmark baseline: {}".format(node))
+
+    threshold = benchmark_threshold(bld)
+    regressions = []
+
+    for result in getattr(bld, "runner_results", []):
+        if result["run_type"] != "benchmark" or result["name"] not in baseline:
+            continue
+
+        baseline_time = baseline[result["name"]]["time"]
+        current_time = benchmark_time(result)
+        # A relative slowdown cannot be computed without a baseline time
+        if not baseline_time:
+            continue
+
+        if current_time > baseline_time * (1.0 + threshold):
+            regressions.append(
+                "{}: {:.4f} s (baseline {}: {:.4f} s, {:+.1f}%)".format(
+                    result["name"],
+                    current_time,
+                    name,
+                    baseline_time,
+                    100.0 * (current_time - baseline_time) / baseline_time,
+                )
+            )
+
+    return regressions
+
+
+def save_benchmark_results(bld):
+    """
+    Store the results that are reported by the benchmarks in this build in
+    one file in the build folder, keyed by the binary and benchmark name
+    """
+    results = {}
+    for result in getattr(bld, "runner_results", []):
+        if "benchmark_results" in result:
+            results[result["name"]] = result["benchmark_results"]
+
+    if results:
+        node = bld.bldnode.make_node(benchmark_results_file)
+        node.write(json.dumps(results, indent=2, sort_keys=True))
+
+
+def format_rate(rate, unit):
+    """
+    Return a rate (e.g. bytes per second) with a metric prefix
+    """
+    for prefix in ["", "k", "M", "G"]:
+        if rate < 1000.0:
+            break
+        rate /= 1000.0
+    else:
+        prefix = "T"
+
+    return "{:.2f} {}{}/s".format(rate, prefix, unit)
+
+
+def write_report(bld):
+    """
+    Write the results of the runs to the file given by the run_report
+    option. Each result contains the command, the return code, the output,
+    the wall-clock time, the CPU time and the peak memory usage of a run.
+    """
+    if not bld.has_tool_option("run_report"):
+        return
+
+    lst = getattr(bld, "runner_results", [])
+    report = bld.get_tool_option("run_report")
+
+    if report.endswith(".xml"):
+        content = junit_report(lst)
     else:
-        taskgen.bld.add_post_fun(set_exit_code)
-        taskgen.bld.add_post_fun(summary)
+        content = json.dumps(lst, indent=2, sort_keys=True)
+
+    # A relative path is relative to the directory where waf was invoked.
+    # The path is joined first, since make_node drops the leading "/" of an
+    # absolute path.
+    node = bld.root.make_node(os.path.join(bld.launch_dir, report))
+    node.parent.mkdir()
+    node.write(content)
+
+
+def junit_report(lst):
+    """
+    Return the results of the runs in the JUnit XML format, where each
+    run type (e.g. test or benchmark) is a test suite
+    """
+    testsuites = ElementTree.Element("testsuites")
+
+    for run_type in sorted(set(result["run_type"] for result in lst)):
+        results = [result for result in lst if result["run_type"] == run_type]
+        failures = [result for result in results if result["return_code"]]
+
+        testsuite = ElementTree.SubElement(
+            testsuites,
+            "testsuite",
+            name=run_type,
+            tests=str(len(results)),
+            failures=str(len(failures)),
+            time="{:.3f}".format(sum(result["wall_time"] for result in results)),
+        )
+
+        for result in results:
+            testcase = ElementTree.SubElement(
+                testsuite,
+                "testcase",
+                name=result["name"],
+                classname=run_type,
+                time="{:.3f}".format(result["wall_time"]),
+            )
+            if result["return_code"]:
+                if result["timed_out"]:
+                    message = "Timeout"
+                else:
+                    message = "Return code: {}".format(result["return_code"])
+                failure = ElementTree.SubElement(testcase, "failure", message=message)
+                failure.text = xml_invalid_chars.sub("", result["stdout"])
+            else:
+                system_out = ElementTree.SubElement(testcase, "system-out")
+                system_out.text = xml_invalid_chars.sub("", result["stdout"])
+
+    return ElementTree.tostring(testsuites, encoding="unicode")
 
 
 def summary(bld):
@@ -296,18 +1156,103 @@ def summary(bld):
         Logs.pprint("CYAN", "Execution Summary:")
 
         total = len(lst)
-        fail = len([x for x in lst if x[1]])
+        fail = len([x for x in lst if x["return_code"]])
 
         Logs.pprint("CYAN", "  successful runs %d/%d" % (total - fail, total))
-        for (filename, return_code, stdout) in lst:
-            if return_code == 0:
-                Logs.pprint("CYAN", "    %s" % filename)
+        for result in lst:
+            if result["return_code"] == 0 and result["cached"]:
+                Logs.pprint("CYAN", "    %s (cached)" % result["cmd"])
+            elif result["return_code"] == 0:
+                Logs.pprint(
+                    "CYAN", "    %s (%.3f s)" % (result["cmd"], result["wall_time"])
+                )
 
         if fail != 0:
             Logs.pprint("CYAN", "  failed runs %d/%d" % (fail, total))
-            for (filename, return_code, stdout) in lst:
-                if return_code != 0:
-                    Logs.pprint("CYAN", "     %s" % filename)
+            for result in lst:
+                if result["return_code"] != 0:
+                    Logs.pprint(
+                        "CYAN",
+                        "     %s (%.3f s%s)"
+                        % (
+                            result["cmd"],
+                            result["wall_time"],
+                            ", timeout" if result["timed_out"] else "",
+                        ),
+                    )
+
+    flaky = [x for x in lst if x.get("status") == "flaky"]
+    if flaky:
+        history = get_run_history(bld)
+        Logs.pprint("YELLOW", "  flaky runs %d/%d" % (len(flaky), len(lst)))
+        for result in flaky:
+            Logs.pprint(
+                "YELLOW",
+                "     %s (passed after %d attempts)"
+                % (result["cmd"], result["attempts"]),
+            )
+        flaky_history = sorted(
+            (entry["flaky"], entry["runs"], key)
+            for key, entry in history.items()
+            if entry.get("flaky")
+        )
+        if flaky_history:
+            Logs.pprint("YELLOW", "  flaky history (flaky/total runs):")
+            for flaky_runs, runs, key in reversed(flaky_history):
+                Logs.pprint("YELLOW", "     %s %d/%d" % (key, flaky_runs, runs))
+
+    cancelled = getattr(bld, "runner_cancelled", [])
+    if cancelled:
+        Logs.pprint("CYAN", "  cancelled runs %d" % len(cancelled))
+        for cmd in cancelled:
+            Logs.pprint("CYAN", "     %s" % cmd)
+
+    benchmarks = [x for x in lst if "benchmark" in x]
+    if benchmarks:
+        Logs.pprint("CYAN", "Benchmark Summary (wall-clock time in seconds):")
+        Logs.pprint(
+            "CYAN",
+            "  %-30s %6s %10s %10s %23s"
+            % ("benchmark", "runs", "median", "MAD", "95% CI of median"),
+        )
+        for result in benchmarks:
+            stats = result["benchmark"]
+            Logs.pprint(
+                "CYAN",
+                "  %-30s %6d %10.4f %10.4f %10.4f - %10.4f"
+                % (
+                    result["name"],
+                    stats["repeat"],
+                    stats["median"],
+                    stats["mad"],
+                    stats["ci_low"],
+                    stats["ci_high"],
+                ),
+            )
+
+    reported = [x for x in lst if "benchmark_results" in x]
+    if reported:
+        Logs.pprint("CYAN", "Benchmark Results:")
+        for result in reported:
+            Logs.pprint("CYAN", "  %s" % result["name"])
+            for name, entry in sorted(result["benchmark_results"].items()):
+                throughput = []
+                if "bytes_per_second" in entry:
+                    throughput.append(format_rate(entry["bytes_per_second"], "B"))
+                if "items_per_second" in entry:
+                    throughput.append(format_rate(entry["items_per_second"], " items"))
+
+                real_time = ""
+                if "real_time" in entry:
+                    real_time = "%.2f %s" % (
+                        entry["real_time"],
+                        entry.get("time_unit", ""),
+                    )
+
+                Logs.pprint(
+                    "CYAN",
+                    "    %-40s %15s  %s" % (name, real_time, "  ".join(throughput)),
+                )
 
 
 def set_exit_code(bld):
@@ -323,11 +1268,27 @@ def set_exit_code(bld):
         bld.add_post_fun(waf_unit_test.set_exit_code)
     """
     lst = getattr(bld, "runner_results", [])
-    for (cmd, return_code, stdout) in lst:
-        if return_code:
+    for result in lst:
+        if result["return_code"]:
             # If this was a "silent" run, we should print the full output
             if bld.has_tool_option("run_silent"):
-                Logs.pprint("RED", stdout)
+                Logs.pprint("RED", result["stdout"])
+            if result["timed_out"]:
+                bld.fatal('Command "{}" timed out'.format(result["cmd"]))
+            bld.fatal(
+                'Command "{}" failed with return code: {}'.format(
+                    result["cmd"], result["return_code"]
+                )
+            )
+
+    # Fail the build if any benchmark is slower than the baseline
+    if bld.has_tool_option("benchmark_compare"):
+        regressions = benchmark_regressions(bld)
+        if regressions:
+            for regression in regressions:
+                Logs.pprint("RED", regression)
             bld.fatal(
-                'Command "{}" failed with return code: {}'.format(cmd, return_code)
+                "{} benchmark(s) regressed by more than {}".format(
+                    len(regressions), bld.get_tool_option("benchmark_threshold")
+                )
             )
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Cache for the results of the configure checks that only depend on the
+installed tools (e.g. the C++ standards that are supported by a compiler).
+
+The cache is shared by all projects and build folders of the user. It is
+stored in $XDG_CACHE_HOME/wurf (~/.cache/wurf by default), and it can be
+disabled with the '--cxx_no_cache' option. Each cache is a JSON file that
+maps a key (e.g. a hash of the compiler path and flags) to the cached value
+and the state it depends on (e.g. the identity of the compiler binary). An
+entry is replaced when its state changes, and the oldest entries are
+removed when a cache has more than max_entries entries, so the cache files
+do not grow without bound.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+from waflib import Logs
+from waflib import Utils
+
+# Guards the read-modify-write cycle of the cache files
+cachelock = Utils.threading.Lock()
+
+# The maximum number of entries in a cache file
+max_entries = 256
+
+
+def cache_dir():
+    """
+    Return the folder of the user-level cache
+    """
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "wurf")
+
+
+def is_enabled(ctx):
+    """
+    Return True if the user-level cache is used
+    """
+    return not ctx.has_tool_option("cxx_no_cache")
+
+
+def file_identity(path):
+    """
+    Return the real path, the modification time and the size of a file,
+    or None if the file does not exist. The identity changes when the file
+    is replaced (e.g. when a compiler is upgraded).
+    """
+    try:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return [path, st.st_mtime_ns, st.st_size]
+
+
+def make_key(*values):
+    """
+    Return a cache key for the given JSON serializable values
+    """
+    data = json.dumps(values, sort_keys=True)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def load(name):
+    """
+    Return the content of the cache with the given name, an empty dict is
+    returned if the cache does not exist or it is invalid
+    """
+    path = os.path.join(cache_dir(), name + ".json")
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return data if isinstance(data, dict) else {}
+
+
+def get(name, key, state=None):
+    """
+    Return the cached value of the key, or None if it is not cached or it
+    was stored with a different state
+
+    :param state: the JSON serializable values that the cached value
+                  depends on (e.g. the identity of a program)
+    """
+    entry = load(name).get(key)
+    if not isinstance(entry, dict) or entry.get("state") != make_key(state):
+        return None
+
+    return entry.get("value")
+
+
+def put(name, key, value, state=None):
+    """
+    Store the value of the key in the cache with the given name, the entry
+    of the key is replaced if it exists. The cache file is replaced
+    atomically, so concurrent configure runs never read a partially
+    written file. Failing to write the cache is not an error.
+
+    :param state: the JSON serializable values that the value depends on,
+                  see get()
+    """
+    folder = cache_dir()
+    path = os.path.join(folder, name + ".json")
+
+    with cachelock:
+        data = load(name)
+        data[key] = {"state": make_key(state), "value": value, "time": time.time()}
+
+        # The entries that were written first are removed
+        def written(entry_key):
+            entry = data[entry_key]
+            return entry.get("time", 0) if isinstance(entry, dict) else 0
+
+        if len(data) > max_entries:
+            for old in sorted(data, key=written)[: len(data) - max_entries]:
+                del data[old]
+
+        try:
+            os.makedirs(folder, exist_ok=True)
+
+            fd, tmp = tempfile.mkstemp(dir=folder, prefix=name, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except (OSError, TypeError, ValueError) as e:
+            Logs.debug("cache: could not write {}: {}".format(path, e))